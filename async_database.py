@@ -0,0 +1,93 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import database
+import singleflight
+
+# Отдельные потоки для работы с SQLite, чтобы обработчики не блокировали цикл событий
+DB_WORKERS = 4
+_executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix='db')
+
+
+def _run_in_db_thread(func):
+    """
+    Превращает синхронную функцию из database.py в корутину, выполняемую в потоке БД.
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+    return wrapper
+
+
+def _coalesced(func):
+    """
+    Объединяет одновременные одинаковые запросы на чтение в один запрос к БД.
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        key = (func.__name__, args, tuple(sorted(kwargs.items())))
+        result = await singleflight.run(key, lambda: func(*args, **kwargs))
+        # Общий результат копируется, чтобы изменения списка одним обработчиком не влияли на другие
+        return list(result) if isinstance(result, list) else result
+    return wrapper
+
+
+def _invalidates_lookups(func):
+    """
+    После записи сбрасывает объединенные запросы, чтобы следующие чтения увидели новые данные.
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            singleflight.forget_all()
+    return wrapper
+
+
+def shutdown():
+    """
+    Дожидается завершения всех запросов к БД и останавливает пул потоков.
+    """
+    _executor.shutdown(wait=True)
+
+
+init_db = _run_in_db_thread(database.init_db)
+add_product = _invalidates_lookups(_run_in_db_thread(database.add_product))
+get_products_page = _run_in_db_thread(database.get_products_page)
+search_products_by_size = _run_in_db_thread(database.search_products_by_size)
+get_product_by_id = _coalesced(_run_in_db_thread(database.get_product_by_id))
+get_products_by_ids = _run_in_db_thread(database.get_products_by_ids)
+update_message_id = _invalidates_lookups(_run_in_db_thread(database.update_message_id))
+update_product_sizes = _invalidates_lookups(_run_in_db_thread(database.update_product_sizes))
+decrement_stock_items = _invalidates_lookups(_run_in_db_thread(database.decrement_stock_items))
+increment_stock = _invalidates_lookups(_run_in_db_thread(database.increment_stock))
+update_product_price = _invalidates_lookups(_run_in_db_thread(database.update_product_price))
+set_product_sold = _invalidates_lookups(_run_in_db_thread(database.set_product_sold))
+delete_product_by_id = _invalidates_lookups(_run_in_db_thread(database.delete_product_by_id))
+get_post_render_hash = _run_in_db_thread(database.get_post_render_hash)
+save_post_render_hash = _run_in_db_thread(database.save_post_render_hash)
+add_reservations = _run_in_db_thread(database.add_reservations)
+release_reservations = _run_in_db_thread(database.release_reservations)
+release_expired_reservations = _run_in_db_thread(database.release_expired_reservations)
+extend_reservation_deadlines = _run_in_db_thread(database.extend_reservation_deadlines)
+get_all_reservations = _run_in_db_thread(database.get_all_reservations)
+add_faq = _run_in_db_thread(database.add_faq)
+delete_faq_by_id = _run_in_db_thread(database.delete_faq_by_id)
+find_faq_by_keywords = _run_in_db_thread(database.find_faq_by_keywords)
+get_all_faq = _run_in_db_thread(database.get_all_faq)
+set_chat_status = _run_in_db_thread(database.set_chat_status)
+claim_waiting_chat = _run_in_db_thread(database.claim_waiting_chat)
+get_chat_by_user_id = _run_in_db_thread(database.get_chat_by_user_id)
+add_or_update_customer = _run_in_db_thread(database.add_or_update_customer)
+create_order = _run_in_db_thread(database.create_order)
+add_item_to_order = _run_in_db_thread(database.add_item_to_order)
+place_order = _run_in_db_thread(database.place_order)
+delete_chat = _run_in_db_thread(database.delete_chat)
+add_message_to_history = _run_in_db_thread(database.add_message_to_history)
+flush_message_history = _run_in_db_thread(database.flush_message_history)
+get_history_for_user = _run_in_db_thread(database.get_history_for_user)
+get_chat_by_admin_id = _run_in_db_thread(database.get_chat_by_admin_id)
+get_last_order_summary = _run_in_db_thread(database.get_last_order_summary)
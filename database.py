@@ -1,227 +1,465 @@
-import sqlite3
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+
+import inventory
+import product_cache
+import search_cache
+from db_connection import read_connection, write_transaction
+from faq_matcher import FaqMatcher
+from inventory import size_sort_key
+from migrations import migrate
+
+CATALOG_PAGE_SIZE = 10
+SEARCH_PAGE_SIZE = 9
+
+# Буфер истории переписки: строки копятся в памяти и записываются одной транзакцией
+HISTORY_FLUSH_SIZE = 50
+HISTORY_FLUSH_INTERVAL = 5.0
+
+_history_buffer = []
+_history_buffer_started_at = None
+# Строки, которые сейчас записываются в БД: читатели берут их из памяти, пока транзакция не зафиксирована
+_history_flushing = []
+# Наибольший ID истории, который читатели берут из БД; строки с большим ID еще лежат в _history_flushing
+_history_visible_id = 0
+_history_lock = threading.Lock()
+# Сериализует записи буфера, чтобы партии попадали в БД по порядку; _history_lock во время записи не держится
+_history_flush_lock = threading.Lock()
+
+# Скомпилированный автомат FAQ; пересобирается только после изменения таблицы faq
+_faq_matcher = None
+_faq_lock = threading.Lock()
 
 
 def init_db():
     """
-    Инициализирует базу данных: подключается к shoes_bot.db и создает все необходимые таблицы, если они не существуют.
+    Инициализирует базу данных: применяет миграции схемы, которые еще не были выполнены,
+    и загружает остатки непроданных товаров в счетчики inventory.
     """
-    conn = sqlite3.connect('shoes_bot.db')
-    cursor = conn.cursor()
+    global _history_visible_id
+    migrate()
+    with read_connection() as conn:
+        _history_visible_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM message_history").fetchone()[0]
+        rows = conn.execute("""
+            SELECT ps.product_id, ps.size, ps.quantity
+            FROM products p
+            JOIN product_sizes ps ON ps.product_id = p.id
+            WHERE p.is_sold = 0 AND ps.quantity > 0
+        """).fetchall()
+    inventory.load_stock(rows)
 
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS products (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            file_id TEXT NOT NULL,
-            price INTEGER NOT NULL,
-            sizes TEXT NOT NULL,
-            is_sold INTEGER DEFAULT 0,
-            message_id INTEGER
-        )
-    ''')
-
-    # Проверяем, существует ли колонка insole_lengths_json
-    cursor.execute("PRAGMA table_info(products)")
-    columns = [column[1] for column in cursor.fetchall()]
-    if 'insole_lengths_json' not in columns:
-        cursor.execute("ALTER TABLE products ADD COLUMN insole_lengths_json TEXT")
-
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS faq (
-            id INTEGER PRIMARY KEY,
-            keywords TEXT NOT NULL,
-            answer TEXT NOT NULL
-        )
-    ''')
-
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS live_chats (
-            user_id INTEGER PRIMARY KEY,
-            admin_id INTEGER,
-            status TEXT NOT NULL,
-            last_update TIMESTAMP
-        )
-    ''')
-
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS message_history (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER NOT NULL,
-            message_text TEXT NOT NULL,
-            sender_type TEXT NOT NULL,
-            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS customers (
-            user_id INTEGER PRIMARY KEY,
-            full_name TEXT,
-            phone_number TEXT
-        )
-    ''')
-
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS orders (
-            order_id INTEGER PRIMARY KEY AUTOINCREMENT,
-            customer_user_id INTEGER,
-            delivery_address TEXT,
-            ttn TEXT,
-            status TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS order_items (
-            item_id INTEGER PRIMARY KEY AUTOINCREMENT,
-            order_id INTEGER,
-            product_id INTEGER,
-            size TEXT,
-            price_at_purchase INTEGER
-        )
-    ''')
-
-    conn.commit()
-    conn.close()
 
-
-def add_product(file_id: str, price: int, sizes: list[int], insole_lengths_json: str):
+def _stocked_sizes(cursor, product_id: int) -> set[str]:
     """
-    Добавляет новый товар в базу данных и возвращает его ID.
+    Возвращает размеры, которые сейчас числятся у товара в product_sizes.
     """
-    conn = sqlite3.connect('shoes_bot.db')
-    cursor = conn.cursor()
+    cursor.execute("SELECT size FROM product_sizes WHERE product_id = ?", (product_id,))
+    return {row[0] for row in cursor.fetchall()}
 
-    sizes_str = ",".join(map(str, sorted(sizes)))
-    cursor.execute("INSERT INTO products (file_id, price, sizes, insole_lengths_json) VALUES (?, ?, ?, ?)",
-                   (file_id, price, sizes_str, insole_lengths_json))
-    product_id = cursor.lastrowid
 
-    conn.commit()
-    conn.close()
-    return product_id
+def _size_counts(sizes) -> Counter:
+    """
+    Считает пары по размерам в списке размеров (пустые значения пропускаются).
+    """
+    return Counter(str(size).strip() for size in sizes if str(size).strip())
 
 
-def get_all_products():
+def _write_product_sizes(cursor, product_id: int, sizes: list) -> set[str]:
     """
-    Возвращает список всех товаров, которые не проданы.
+    Перезаписывает остатки товара в product_sizes и синхронизирует с ними
+    строку products.sizes и флаг is_sold.
+    Возвращает размеры, остатки которых могли измениться (старые и новые).
     """
-    conn = sqlite3.connect('shoes_bot.db')
-    conn.row_factory = sqlite3.Row  # Позволяет обращаться к колонкам по имени
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, file_id, price, sizes FROM products WHERE is_sold = 0")
-    products = cursor.fetchall()
-    conn.close()
-    return products
+    counts = _size_counts(sizes)
+    changed_sizes = _stocked_sizes(cursor, product_id) | set(counts)
+    cursor.execute("DELETE FROM product_sizes WHERE product_id = ?", (product_id,))
+    cursor.executemany(
+        "INSERT INTO product_sizes (product_id, size, quantity) VALUES (?, ?, ?)",
+        [(product_id, size, quantity) for size, quantity in counts.items()]
+    )
+    sizes_str = ",".join(sorted(counts.elements(), key=size_sort_key))
+    # Если размеры закончились, помечаем товар как проданный, иначе — как не проданный
+    is_sold = 0 if sizes_str else 1
+    cursor.execute("UPDATE products SET sizes = ?, is_sold = ? WHERE id = ?", (sizes_str, is_sold, product_id))
+    return changed_sizes
 
 
-def get_products_by_size(size):
+def add_product(file_id: str, price: int, sizes: list[int], insole_lengths_json: str):
     """
-    Возвращает список всех товаров, которые не проданы и доступны в указанном размере.
+    Добавляет новый товар в базу данных и возвращает его ID.
     """
-    conn = sqlite3.connect('shoes_bot.db')
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    size_str = str(size)
-    # Ищем точное совпадение, или в начале, или в конце, или в середине списка
-    cursor.execute("""
-        SELECT * FROM products
-        WHERE is_sold = 0 AND (
-            sizes = ? OR
-            sizes LIKE ? OR
-            sizes LIKE ? OR
-            sizes LIKE ?
-        )
-    """, (size_str, f"{size_str},%", f"%,{size_str}", f"%,{size_str},%"))
-    products = cursor.fetchall()
-    conn.close()
-    return products
+    with write_transaction() as cursor:
+        cursor.execute("INSERT INTO products (file_id, price, sizes, insole_lengths_json) VALUES (?, ?, '', ?)",
+                       (file_id, price, insole_lengths_json))
+        product_id = cursor.lastrowid
+        # Строка sizes и остатки в product_sizes заполняются вместе
+        changed_sizes = _write_product_sizes(cursor, product_id, sizes)
+    inventory.set_stock(product_id, _size_counts(sizes))
+    search_cache.invalidate_sizes(changed_sizes)
+    return product_id
+
+
+def get_products_page(after_id: int = 0, before_id: int | None = None, limit: int = CATALOG_PAGE_SIZE):
+    """
+    Возвращает страницу непроданных товаров по ключу id (keyset-пагинация) в порядке возрастания id.
+    Страница начинается после after_id, а если задан before_id — заканчивается перед ним.
+    Результат: (товары, есть ли предыдущая страница, есть ли следующая страница).
+    """
+    with read_connection() as conn:
+        if before_id is None:
+            products = conn.execute("""
+                SELECT id, file_id, price, sizes FROM products
+                WHERE is_sold = 0 AND id > ? ORDER BY id LIMIT ?
+            """, (after_id, limit + 1)).fetchall()
+            has_next = len(products) > limit
+            products = products[:limit]
+            has_prev = conn.execute(
+                "SELECT 1 FROM products WHERE is_sold = 0 AND id <= ? LIMIT 1", (after_id,)
+            ).fetchone() is not None
+        else:
+            products = conn.execute("""
+                SELECT id, file_id, price, sizes FROM products
+                WHERE is_sold = 0 AND id < ? ORDER BY id DESC LIMIT ?
+            """, (before_id, limit + 1)).fetchall()
+            has_prev = len(products) > limit
+            products = products[:limit][::-1]
+            has_next = conn.execute(
+                "SELECT 1 FROM products WHERE is_sold = 0 AND id >= ? LIMIT 1", (before_id,)
+            ).fetchone() is not None
+    return products, has_prev, has_next
+
+
+def search_products_by_size(size, after_id: int = 0, before_id: int | None = None, limit: int = SEARCH_PAGE_SIZE):
+    """
+    Возвращает страницу непроданных товаров, у которых есть свободные пары размера size,
+    по ключу product_id (keyset-пагинация) в порядке возрастания id.
+    Забронированные пары (таблица reservations) не считаются свободными.
+    Страница начинается после after_id, а если задан before_id — заканчивается перед ним.
+    Результат: (товары с колонкой size_quantity, есть ли предыдущая страница, есть ли следующая страница).
+    """
+    available = """
+        FROM product_sizes ps
+        JOIN products p ON p.id = ps.product_id
+        WHERE ps.size = ? AND p.is_sold = 0
+          AND ps.quantity > (SELECT COUNT(*) FROM reservations r
+                             WHERE r.product_id = ps.product_id AND r.size = ps.size)
+    """
+    params = (str(size),)
+    with read_connection() as conn:
+        if before_id is None:
+            products = conn.execute(
+                f"SELECT p.*, ps.quantity AS size_quantity {available} AND ps.product_id > ? "
+                f"ORDER BY ps.product_id LIMIT ?", params + (after_id, limit + 1)
+            ).fetchall()
+            has_next = len(products) > limit
+            products = products[:limit]
+            has_prev = conn.execute(
+                f"SELECT 1 {available} AND ps.product_id <= ? LIMIT 1", params + (after_id,)
+            ).fetchone() is not None
+        else:
+            products = conn.execute(
+                f"SELECT p.*, ps.quantity AS size_quantity {available} AND ps.product_id < ? "
+                f"ORDER BY ps.product_id DESC LIMIT ?", params + (before_id, limit + 1)
+            ).fetchall()
+            has_prev = len(products) > limit
+            products = products[:limit][::-1]
+            has_next = conn.execute(
+                f"SELECT 1 {available} AND ps.product_id >= ? LIMIT 1", params + (before_id,)
+            ).fetchone() is not None
+    return products, has_prev, has_next
 
 
 def get_product_by_id(product_id: int):
     """
     Возвращает информацию о товаре по его ID.
-    """
-    conn = sqlite3.connect('shoes_bot.db')
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM products WHERE id = ?", (product_id,))
-    product = cursor.fetchone()
-    conn.close()
+    Результат кэшируется в product_cache до изменения товара.
+    """
+    product, generation = product_cache.get(product_id)
+    if product is not None:
+        return product
+    with read_connection() as conn:
+        product = conn.execute("SELECT * FROM products WHERE id = ?", (product_id,)).fetchone()
+    if product is not None:
+        product_cache.put(product_id, product, generation)
     return product
 
 
+def get_products_by_ids(product_ids) -> dict:
+    """
+    Возвращает товары с указанными ID одним запросом в виде словаря {id: товар}.
+    Товары, уже находящиеся в кэше, из БД не читаются.
+    """
+    products = {}
+    missing_ids = []
+    generation = None
+    for product_id in dict.fromkeys(product_ids):
+        product, lookup_generation = product_cache.get(product_id)
+        if generation is None:
+            generation = lookup_generation
+        if product is not None:
+            products[product_id] = product
+        else:
+            missing_ids.append(product_id)
+    if not missing_ids:
+        return products
+
+    placeholders = ",".join("?" * len(missing_ids))
+    with read_connection() as conn:
+        rows = conn.execute(f"SELECT * FROM products WHERE id IN ({placeholders})", missing_ids).fetchall()
+    for row in rows:
+        product_cache.put(row['id'], row, generation)
+        products[row['id']] = row
+    return products
+
+
 def update_message_id(product_id: int, message_id: int):
     """
     Обновляет message_id для указанного товара.
     """
-    conn = sqlite3.connect('shoes_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("UPDATE products SET message_id = ? WHERE id = ?", (message_id, product_id))
-    conn.commit()
-    conn.close()
+    with write_transaction() as cursor:
+        cursor.execute("UPDATE products SET message_id = ? WHERE id = ?", (message_id, product_id))
+    product_cache.invalidate(product_id)
 
 
 def update_product_sizes(product_id, new_sizes):
     """
     Обновляет список доступных размеров для товара и флаг is_sold.
-    """
-    conn = sqlite3.connect('shoes_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("UPDATE products SET sizes = ? WHERE id = ?", (new_sizes, product_id))
-    if not new_sizes:
-        # Если размеры закончились, помечаем товар как проданный
-        cursor.execute("UPDATE products SET is_sold = 1 WHERE id = ?", (product_id,))
-    else:
-        # Если размеры есть, помечаем товар как не проданный
-        cursor.execute("UPDATE products SET is_sold = 0 WHERE id = ?", (product_id,))
-    conn.commit()
-    conn.close()
+    new_sizes — строка размеров через запятую, остатки пересчитываются в product_sizes.
+    """
+    sizes = new_sizes.split(',') if new_sizes else []
+    with write_transaction() as cursor:
+        changed_sizes = _write_product_sizes(cursor, product_id, sizes)
+    product_cache.invalidate(product_id)
+    inventory.set_stock(product_id, _size_counts(sizes))
+    search_cache.invalidate_sizes(changed_sizes)
+
+
+def _sync_product_row(cursor, product_id: int) -> Counter:
+    """
+    Пересчитывает строку products.sizes и флаг is_sold по остаткам в product_sizes.
+    Возвращает остатки товара по размерам.
+    """
+    cursor.execute("SELECT size, quantity FROM product_sizes WHERE product_id = ?", (product_id,))
+    counts = Counter({size: quantity for size, quantity in cursor.fetchall()})
+    sizes_str = ",".join(sorted(counts.elements(), key=size_sort_key))
+    cursor.execute("UPDATE products SET sizes = ?, is_sold = ? WHERE id = ?",
+                   (sizes_str, 0 if sizes_str else 1, product_id))
+    return counts
+
+
+def decrement_stock_items(items: list[dict]) -> list[bool]:
+    """
+    Списывает по одной паре на каждый элемент items ({'product_id', 'size'}) одной транзакцией:
+    при ошибке не списывается ничего. Каждая пара списывается условным UPDATE, поэтому для пары,
+    которой уже нет в наличии (например, ее списало другое подтверждение), возвращается False,
+    а остальные пары списываются. Результат — список успехов в порядке items.
+    """
+    decremented = []
+    stock_by_product = {}
+    with write_transaction() as cursor:
+        for item in items:
+            product_id, size = item['product_id'], str(item['size'])
+            cursor.execute(
+                "UPDATE product_sizes SET quantity = quantity - 1 WHERE product_id = ? AND size = ? AND quantity > 0",
+                (product_id, size)
+            )
+            decremented.append(cursor.rowcount == 1)
+            if cursor.rowcount == 1:
+                cursor.execute("DELETE FROM product_sizes WHERE product_id = ? AND size = ? AND quantity = 0",
+                               (product_id, size))
+        for product_id in {item['product_id'] for item, success in zip(items, decremented) if success}:
+            stock_by_product[product_id] = _sync_product_row(cursor, product_id)
+    for product_id, counts in stock_by_product.items():
+        product_cache.invalidate(product_id)
+        inventory.set_stock(product_id, counts)
+    search_cache.invalidate_sizes(item['size'] for item, success in zip(items, decremented) if success)
+    return decremented
+
+
+def increment_stock(product_id: int, size) -> bool:
+    """
+    Возвращает в наличие одну пару размера size в одной транзакции.
+    Возвращает False, если товара с таким ID нет.
+    """
+    size = str(size)
+    with write_transaction() as cursor:
+        cursor.execute("SELECT 1 FROM products WHERE id = ?", (product_id,))
+        if cursor.fetchone() is None:
+            return False
+        cursor.execute("""
+            INSERT INTO product_sizes (product_id, size, quantity) VALUES (?, ?, 1)
+            ON CONFLICT (product_id, size) DO UPDATE SET quantity = quantity + 1
+        """, (product_id, size))
+        counts = _sync_product_row(cursor, product_id)
+    product_cache.invalidate(product_id)
+    inventory.set_stock(product_id, counts)
+    search_cache.invalidate_sizes([size])
+    return True
 
 
 def update_product_price(product_id: int, new_price: int):
     """
     Обновляет цену для указанного товара.
     """
-    conn = sqlite3.connect('shoes_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("UPDATE products SET price = ? WHERE id = ?", (new_price, product_id))
-    conn.commit()
-    conn.close()
+    with write_transaction() as cursor:
+        cursor.execute("UPDATE products SET price = ? WHERE id = ?", (new_price, product_id))
+        # Цена входит в подписи кнопок поиска по всем размерам товара
+        changed_sizes = _stocked_sizes(cursor, product_id)
+    product_cache.invalidate(product_id)
+    search_cache.invalidate_sizes(changed_sizes)
 
 
 def set_product_sold(product_id: int):
     """
     Устанавливает для товара статус 'продано'.
     """
-    conn = sqlite3.connect('shoes_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("UPDATE products SET is_sold = 1 WHERE id = ?", (product_id,))
-    conn.commit()
-    conn.close()
+    with write_transaction() as cursor:
+        cursor.execute("UPDATE products SET is_sold = 1 WHERE id = ?", (product_id,))
+        changed_sizes = _stocked_sizes(cursor, product_id)
+    product_cache.invalidate(product_id)
+    inventory.set_stock(product_id, Counter())
+    search_cache.invalidate_sizes(changed_sizes)
 
 
 def delete_product_by_id(product_id: int):
     """
-    Удаляет товар из базы данных по его ID.
+    Удаляет товар из базы данных по его ID вместе с остатками и бронями.
+    """
+    with write_transaction() as cursor:
+        changed_sizes = _stocked_sizes(cursor, product_id)
+        cursor.execute("DELETE FROM product_sizes WHERE product_id = ?", (product_id,))
+        cursor.execute("DELETE FROM reservations WHERE product_id = ?", (product_id,))
+        cursor.execute("DELETE FROM products WHERE id = ?", (product_id,))
+    product_cache.invalidate(product_id)
+    inventory.drop_product(product_id)
+    search_cache.invalidate_sizes(changed_sizes)
+
+
+def get_post_render_hash(message_id: int) -> str | None:
+    """
+    Возвращает хэш последней опубликованной подписи и клавиатуры поста в канале.
+    """
+    with read_connection() as conn:
+        row = conn.execute("SELECT render_hash FROM channel_posts WHERE message_id = ?", (message_id,)).fetchone()
+    return row['render_hash'] if row else None
+
+
+def save_post_render_hash(message_id: int, product_id: int, render_hash: str):
+    """
+    Сохраняет хэш подписи и клавиатуры, которые сейчас опубликованы в посте канала.
+    """
+    with write_transaction() as cursor:
+        cursor.execute(
+            "INSERT OR REPLACE INTO channel_posts (message_id, product_id, render_hash, updated_at) "
+            "VALUES (?, ?, ?, CURRENT_TIMESTAMP)",
+            (message_id, product_id, render_hash)
+        )
+
+
+def _format_timestamp(moment: datetime | None) -> str | None:
+    """
+    Переводит момент времени в строку UTC в формате, который SQLite использует для CURRENT_TIMESTAMP.
+    """
+    return moment.astimezone(timezone.utc).strftime('%Y-%m-%d %H:%M:%S') if moment else None
+
+
+def add_reservations(user_id: int, items: list[dict], expires_at: datetime | None) -> list[int] | None:
+    """
+    Бронирует для пользователя пары из items ({'product_id', 'size'}) до expires_at одной транзакцией.
+    Свободные пары проверяются в той же транзакции (BEGIN IMMEDIATE), поэтому две корзины
+    не могут забронировать одну и ту же последнюю пару.
+    Возвращает ID созданных броней или None, если хотя бы одного размера не хватает — тогда не бронируется ничего.
+    """
+    reservation_ids = []
+    needed = Counter((item['product_id'], str(item['size'])) for item in items)
+    with write_transaction() as cursor:
+        for (product_id, size), count in needed.items():
+            cursor.execute("""
+                SELECT ps.quantity - (SELECT COUNT(*) FROM reservations r
+                                      WHERE r.product_id = ps.product_id AND r.size = ps.size)
+                FROM product_sizes ps
+                JOIN products p ON p.id = ps.product_id
+                WHERE ps.product_id = ? AND ps.size = ? AND p.is_sold = 0
+            """, (product_id, size))
+            row = cursor.fetchone()
+            if row is None or row[0] < count:
+                return None
+        for item in items:
+            cursor.execute(
+                "INSERT INTO reservations (user_id, product_id, size, expires_at) VALUES (?, ?, ?, ?)",
+                (user_id, item['product_id'], str(item['size']), _format_timestamp(expires_at))
+            )
+            reservation_ids.append(cursor.lastrowid)
+    search_cache.invalidate_sizes(item['size'] for item in items)
+    return reservation_ids
+
+
+def release_reservations(user_id: int, items: list[dict]) -> list[dict]:
+    """
+    Снимает брони пользователя: по одной брони на каждый элемент items ({'product_id', 'size'}).
+    Возвращает элементы, для которых бронь действительно была найдена и снята.
+    """
+    released = []
+    with write_transaction() as cursor:
+        for item in items:
+            cursor.execute(
+                "SELECT id FROM reservations WHERE user_id = ? AND product_id = ? AND size = ? LIMIT 1",
+                (user_id, item['product_id'], str(item['size']))
+            )
+            row = cursor.fetchone()
+            if row is not None:
+                cursor.execute("DELETE FROM reservations WHERE id = ?", (row[0],))
+                released.append(item)
+    search_cache.invalidate_sizes(item['size'] for item in released)
+    return released
+
+
+def release_expired_reservations(now: datetime) -> list[dict]:
+    """
+    Одной транзакцией снимает все брони со сроком не позже now.
+    Возвращает снятые брони в виде словарей {'user_id', 'product_id', 'size'}.
+    """
+    with write_transaction() as cursor:
+        cursor.execute(
+            "SELECT id, user_id, product_id, size FROM reservations WHERE expires_at <= ?", (_format_timestamp(now),)
+        )
+        rows = cursor.fetchall()
+        cursor.executemany("DELETE FROM reservations WHERE id = ?", [(row['id'],) for row in rows])
+    expired = [{'user_id': row['user_id'], 'product_id': row['product_id'], 'size': row['size']} for row in rows]
+    search_cache.invalidate_sizes(item['size'] for item in expired)
+    return expired
+
+
+def extend_reservation_deadlines(user_id: int, expires_at: datetime):
+    """
+    Переносит срок всех броней пользователя на expires_at (оплата отправлена, ждем подтверждения).
     """
-    conn = sqlite3.connect('shoes_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM products WHERE id = ?", (product_id,))
-    conn.commit()
-    conn.close()
+    with write_transaction() as cursor:
+        cursor.execute("UPDATE reservations SET expires_at = ? WHERE user_id = ?",
+                       (_format_timestamp(expires_at), user_id))
+
+
+def get_all_reservations() -> list:
+    """
+    Возвращает все действующие брони в порядке создания.
+    """
+    with read_connection() as conn:
+        reservations = conn.execute(
+            "SELECT id, user_id, product_id, size, expires_at FROM reservations ORDER BY id"
+        ).fetchall()
+    return reservations
 
 
 def add_faq(keywords: str, answer: str) -> int:
     """
     Добавляет новую запись в таблицу FAQ и возвращает ее ID.
     """
-    conn = sqlite3.connect('shoes_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("INSERT INTO faq (keywords, answer) VALUES (?, ?)", (keywords, answer))
-    faq_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
+    with write_transaction() as cursor:
+        cursor.execute("INSERT INTO faq (keywords, answer) VALUES (?, ?)", (keywords, answer))
+        faq_id = cursor.lastrowid
+    _invalidate_faq_matcher()
     return faq_id
 
 
@@ -229,44 +467,42 @@ def delete_faq_by_id(faq_id: int):
     """
     Удаляет запись из таблицы FAQ по ее ID.
     """
-    conn = sqlite3.connect('shoes_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM faq WHERE id = ?", (faq_id,))
-    conn.commit()
-    conn.close()
+    with write_transaction() as cursor:
+        cursor.execute("DELETE FROM faq WHERE id = ?", (faq_id,))
+    _invalidate_faq_matcher()
 
 
-def find_faq_by_keywords(user_message: str) -> str | None:
+def _invalidate_faq_matcher():
     """
-    Ищет ответ в FAQ по ключевым словам в сообщении пользователя.
+    Сбрасывает скомпилированный автомат FAQ, чтобы он был пересобран при следующем поиске.
     """
-    conn = sqlite3.connect('shoes_bot.db')
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute("SELECT keywords, answer FROM faq")
-    all_faqs = cursor.fetchall()
-    conn.close()
+    global _faq_matcher
+    with _faq_lock:
+        _faq_matcher = None
 
-    lower_user_message = user_message.lower()
 
-    for faq_item in all_faqs:
-        keywords = [kw.strip().lower() for kw in faq_item['keywords'].split(',')]
-        if any(keyword in lower_user_message for keyword in keywords if keyword):
-            return faq_item['answer']
+def find_faq_by_keywords(user_message: str) -> str | None:
+    """
+    Ищет ответ в FAQ по ключевым словам в сообщении пользователя.
+    При совпадении нескольких записей возвращается запись с наименьшим ID.
+    """
+    global _faq_matcher
+    with _faq_lock:
+        if _faq_matcher is None:
+            with read_connection() as conn:
+                all_faqs = conn.execute("SELECT keywords, answer FROM faq ORDER BY id").fetchall()
+            _faq_matcher = FaqMatcher((faq_item['keywords'], faq_item['answer']) for faq_item in all_faqs)
+        matcher = _faq_matcher
 
-    return None
+    return matcher.find_answer(user_message)
 
 
 def get_all_faq() -> list:
     """
     Возвращает список всех записей из таблицы FAQ.
     """
-    conn = sqlite3.connect('shoes_bot.db')
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, keywords, answer FROM faq")
-    all_faqs = cursor.fetchall()
-    conn.close()
+    with read_connection() as conn:
+        all_faqs = conn.execute("SELECT id, keywords, answer FROM faq").fetchall()
     return all_faqs
 
 
@@ -274,26 +510,33 @@ def set_chat_status(user_id: int, status: str, admin_id: int = None):
     """
     Создает или обновляет запись о чате для конкретного пользователя.
     """
-    conn = sqlite3.connect('shoes_bot.db')
-    cursor = conn.cursor()
-    cursor.execute(
-        "INSERT OR REPLACE INTO live_chats (user_id, status, admin_id, last_update) VALUES (?, ?, ?, CURRENT_TIMESTAMP)",
-        (user_id, status, admin_id)
-    )
-    conn.commit()
-    conn.close()
+    with write_transaction() as cursor:
+        cursor.execute(
+            "INSERT OR REPLACE INTO live_chats (user_id, status, admin_id, last_update) VALUES (?, ?, ?, CURRENT_TIMESTAMP)",
+            (user_id, status, admin_id)
+        )
+
+
+def claim_waiting_chat(user_id: int, admin_id: int) -> bool:
+    """
+    Передает ожидающий чат администратору одним условным UPDATE.
+    Возвращает False, если чат уже взял другой администратор или его нет.
+    """
+    with write_transaction() as cursor:
+        cursor.execute(
+            "UPDATE live_chats SET status = 'in_progress', admin_id = ?, last_update = CURRENT_TIMESTAMP "
+            "WHERE user_id = ? AND status = 'waiting'",
+            (admin_id, user_id)
+        )
+        return cursor.rowcount == 1
 
 
 def get_chat_by_user_id(user_id: int):
     """
     Получает информацию о чате по user_id.
     """
-    conn = sqlite3.connect('shoes_bot.db')
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM live_chats WHERE user_id = ?", (user_id,))
-    chat_info = cursor.fetchone()
-    conn.close()
+    with read_connection() as conn:
+        chat_info = conn.execute("SELECT * FROM live_chats WHERE user_id = ?", (user_id,)).fetchone()
     return chat_info
 
 
@@ -301,85 +544,164 @@ def add_or_update_customer(user_id: int, full_name: str, phone_number: str):
     """
     Добавляет нового клиента или обновляет данные существующего.
     """
-    conn = sqlite3.connect('shoes_bot.db')
-    cursor = conn.cursor()
+    with write_transaction() as cursor:
+        _upsert_customer(cursor, user_id, full_name, phone_number)
+
+
+def _upsert_customer(cursor, user_id: int, full_name: str, phone_number: str):
+    """
+    Добавляет или обновляет клиента в рамках переданного курсора.
+    """
     cursor.execute(
         "INSERT OR REPLACE INTO customers (user_id, full_name, phone_number) VALUES (?, ?, ?)",
         (user_id, full_name, phone_number)
     )
-    conn.commit()
-    conn.close()
 
 
 def create_order(customer_user_id: int, delivery_address: str, status: str) -> int:
     """
     Создает новую запись о заказе в таблице orders и возвращает ее ID.
     """
-    conn = sqlite3.connect('shoes_bot.db')
-    cursor = conn.cursor()
+    with write_transaction() as cursor:
+        order_id = _insert_order(cursor, customer_user_id, delivery_address, status)
+    return order_id
+
+
+def _insert_order(cursor, customer_user_id: int, delivery_address: str, status: str) -> int:
+    """
+    Создает запись о заказе в рамках переданного курсора и возвращает ее ID.
+    """
     cursor.execute(
         "INSERT INTO orders (customer_user_id, delivery_address, status) VALUES (?, ?, ?)",
         (customer_user_id, delivery_address, status)
     )
-    order_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
-    return order_id
+    return cursor.lastrowid
 
 
 def add_item_to_order(order_id: int, product_id: int, size: str, price_at_purchase: int):
     """
     Добавляет один товар в конкретный заказ в таблице order_items.
     """
-    conn = sqlite3.connect('shoes_bot.db')
-    cursor = conn.cursor()
-    cursor.execute(
+    with write_transaction() as cursor:
+        _insert_order_items(cursor, order_id, [(product_id, size, price_at_purchase)])
+
+
+def _insert_order_items(cursor, order_id: int, items: list[tuple]):
+    """
+    Добавляет товары (product_id, size, price_at_purchase) в заказ одним executemany.
+    """
+    cursor.executemany(
         "INSERT INTO order_items (order_id, product_id, size, price_at_purchase) VALUES (?, ?, ?, ?)",
-        (order_id, product_id, size, price_at_purchase)
+        [(order_id, product_id, size, price_at_purchase) for product_id, size, price_at_purchase in items]
     )
-    conn.commit()
-    conn.close()
+
+
+def place_order(customer: dict, delivery_address: str, items: list[dict], status: str = "Новый") -> int:
+    """
+    Сохраняет клиента, заказ и все его товары одной транзакцией и возвращает ID заказа.
+    customer — словарь с ключами user_id, full_name, phone_number;
+    items — список словарей с ключами product_id, size, price_at_purchase.
+    """
+    with write_transaction() as cursor:
+        _upsert_customer(cursor, customer['user_id'], customer['full_name'], customer['phone_number'])
+        order_id = _insert_order(cursor, customer['user_id'], delivery_address, status)
+        _insert_order_items(cursor, order_id, [
+            (item['product_id'], str(item['size']), item['price_at_purchase']) for item in items
+        ])
+    return order_id
 
 
 def delete_chat(user_id: int):
     """
     Удаляет запись о чате по user_id.
     """
-    conn = sqlite3.connect('shoes_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM live_chats WHERE user_id = ?", (user_id,))
-    conn.commit()
-    conn.close()
+    with write_transaction() as cursor:
+        cursor.execute("DELETE FROM live_chats WHERE user_id = ?", (user_id,))
 
 
 def add_message_to_history(user_id: int, message_text: str, sender_type: str):
     """
     Добавляет одно сообщение в историю переписки.
     sender_type может быть 'user' или 'bot'.
-    """
-    conn = sqlite3.connect('shoes_bot.db')
-    cursor = conn.cursor()
-    cursor.execute(
-        "INSERT INTO message_history (user_id, message_text, sender_type) VALUES (?, ?, ?)",
-        (user_id, message_text, sender_type)
-    )
-    conn.commit()
-    conn.close()
+    Сообщение попадает в буфер и записывается в БД, когда буфер заполнится
+    или пройдет HISTORY_FLUSH_INTERVAL секунд.
+    """
+    global _history_buffer_started_at
+    timestamp = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+    with _history_lock:
+        if not _history_buffer:
+            _history_buffer_started_at = time.monotonic()
+        _history_buffer.append((user_id, message_text, sender_type, timestamp))
+        should_flush = (len(_history_buffer) >= HISTORY_FLUSH_SIZE
+                        or time.monotonic() - _history_buffer_started_at >= HISTORY_FLUSH_INTERVAL)
+    # Если буфер уже записывает другой поток, сообщение уйдет со следующей записью
+    if should_flush and _history_flush_lock.acquire(blocking=False):
+        try:
+            _write_history_batch()
+        finally:
+            _history_flush_lock.release()
+
+
+def _write_history_batch():
+    """
+    Забирает буфер истории под _history_lock и записывает его в БД уже без нее,
+    чтобы add_message_to_history и get_history_for_user не ждали фиксации транзакции.
+    Вызывается под _history_flush_lock.
+    """
+    global _history_visible_id
+    with _history_lock:
+        if not _history_buffer:
+            return
+        _history_flushing.extend(_history_buffer)
+        _history_buffer.clear()
+    try:
+        with write_transaction() as cursor:
+            cursor.executemany(
+                "INSERT INTO message_history (user_id, message_text, sender_type, timestamp) VALUES (?, ?, ?, ?)",
+                _history_flushing
+            )
+            cursor.execute("SELECT MAX(id) FROM message_history")
+            last_id = cursor.fetchone()[0]
+    except BaseException:
+        # Незаписанные строки возвращаются в начало буфера и уйдут со следующей записью
+        with _history_lock:
+            _history_buffer[:0] = _history_flushing
+            _history_flushing.clear()
+        raise
+    with _history_lock:
+        _history_flushing.clear()
+        _history_visible_id = last_id
+
+
+def flush_message_history():
+    """
+    Записывает все сообщения из буфера истории в БД одной транзакцией.
+    """
+    with _history_flush_lock:
+        _write_history_batch()
 
 
 def get_history_for_user(user_id: int, limit: int = 5) -> list:
     """
-    Получает последние 'limit' сообщений для указанного пользователя.
-    """
-    conn = sqlite3.connect('shoes_bot.db')
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT sender_type, message_text FROM message_history WHERE user_id = ? ORDER BY timestamp DESC LIMIT ?",
-        (user_id, limit)
-    )
-    history = cursor.fetchall()
-    conn.close()
+    Получает последние 'limit' сообщений для указанного пользователя,
+    включая еще не записанные в БД сообщения из буфера.
+    """
+    with _history_lock:
+        # Буфер всегда новее записанной истории, поэтому его строки идут первыми
+        history = [
+            {'sender_type': sender_type, 'message_text': message_text}
+            for buffered_user_id, message_text, sender_type, _ in reversed(_history_flushing + _history_buffer)
+            if buffered_user_id == user_id
+        ][:limit]
+        visible_id = _history_visible_id
+    if len(history) < limit:
+        # Строки, которые фиксируются прямо сейчас, уже взяты из памяти: граница по ID не дает прочитать их дважды
+        with read_connection() as conn:
+            history.extend(conn.execute(
+                "SELECT sender_type, message_text FROM message_history WHERE user_id = ? AND id <= ? "
+                "ORDER BY timestamp DESC, id DESC LIMIT ?",
+                (user_id, visible_id, limit - len(history))
+            ).fetchall())
     return history
 
 
@@ -387,12 +709,10 @@ def get_chat_by_admin_id(admin_id: int):
     """
     Находит активный чат ('in_progress') по ID администратора.
     """
-    conn = sqlite3.connect('shoes_bot.db')
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM live_chats WHERE admin_id = ? AND status = 'in_progress'", (admin_id,))
-    chat_info = cursor.fetchone()
-    conn.close()
+    with read_connection() as conn:
+        chat_info = conn.execute(
+            "SELECT * FROM live_chats WHERE admin_id = ? AND status = 'in_progress'", (admin_id,)
+        ).fetchone()
     return chat_info
 
 
@@ -401,32 +721,28 @@ def get_last_order_summary(user_id: int) -> dict | None:
     Находит самый последний заказ для указанного user_id и возвращает
     всю информацию о нем в виде словаря.
     """
-    conn = sqlite3.connect('shoes_bot.db')
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
+    with read_connection() as conn:
+        cursor = conn.cursor()
 
-    # 1. Найти последний заказ
-    cursor.execute(
-        "SELECT * FROM orders WHERE customer_user_id = ? ORDER BY created_at DESC LIMIT 1",
-        (user_id,)
-    )
-    last_order = cursor.fetchone()
-
-    if not last_order:
-        conn.close()
-        return None
+        # 1. Найти последний заказ
+        cursor.execute(
+            "SELECT * FROM orders WHERE customer_user_id = ? ORDER BY created_at DESC LIMIT 1",
+            (user_id,)
+        )
+        last_order = cursor.fetchone()
 
-    order_id = last_order['order_id']
+        if not last_order:
+            return None
 
-    # 2. Получить данные клиента
-    cursor.execute("SELECT * FROM customers WHERE user_id = ?", (user_id,))
-    customer_details = cursor.fetchone()
+        order_id = last_order['order_id']
 
-    # 3. Получить товары в заказе
-    cursor.execute("SELECT * FROM order_items WHERE order_id = ?", (order_id,))
-    order_items = cursor.fetchall()
+        # 2. Получить данные клиента
+        cursor.execute("SELECT * FROM customers WHERE user_id = ?", (user_id,))
+        customer_details = cursor.fetchone()
 
-    conn.close()
+        # 3. Получить товары в заказе
+        cursor.execute("SELECT * FROM order_items WHERE order_id = ?", (order_id,))
+        order_items = cursor.fetchall()
 
     summary = {
         "order_details": dict(last_order) if last_order else {},
@@ -434,4 +750,4 @@ def get_last_order_summary(user_id: int) -> dict | None:
         "items": [dict(item) for item in order_items]
     }
 
-    return summary
\ No newline at end of file
+    return summary
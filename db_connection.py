@@ -0,0 +1,115 @@
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+DB_PATH = 'shoes_bot.db'
+READ_POOL_SIZE = 4
+BUSY_TIMEOUT_MS = 5000
+
+# Настройки применяются к каждому соединению сразу после открытия
+_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}",
+    "PRAGMA cache_size=-16000",  # ~16 МБ страничного кэша
+    "PRAGMA mmap_size=134217728",  # 128 МБ memory-mapped I/O
+    "PRAGMA temp_store=MEMORY",
+)
+
+_writer = None
+_writer_lock = threading.Lock()
+_readers = None
+_readers_created = 0
+_pool_lock = threading.Lock()
+
+
+def _connect() -> sqlite3.Connection:
+    """
+    Открывает новое соединение с базой и применяет к нему PRAGMA-настройки.
+    """
+    conn = sqlite3.connect(DB_PATH, timeout=BUSY_TIMEOUT_MS / 1000, check_same_thread=False,
+                           isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    for pragma in _PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+def configure(path: str):
+    """
+    Переключает менеджер на другой файл базы данных, закрывая открытые соединения.
+    """
+    global DB_PATH
+    close_all()
+    DB_PATH = path
+
+
+@contextmanager
+def write_transaction():
+    """
+    Выдает курсор единственного соединения-писателя внутри транзакции BEGIN IMMEDIATE.
+    При выходе транзакция фиксируется, при исключении — откатывается.
+    """
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = _connect()
+        cursor = _writer.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            yield cursor
+        except BaseException:
+            _writer.rollback()
+            raise
+        else:
+            _writer.commit()
+        finally:
+            cursor.close()
+
+
+@contextmanager
+def read_connection():
+    """
+    Выдает соединение из пула читателей и возвращает его в пул после использования.
+    """
+    global _readers, _readers_created
+    with _pool_lock:
+        if _readers is None:
+            _readers = queue.Queue()
+        pool = _readers
+        conn = None
+        try:
+            conn = pool.get_nowait()
+        except queue.Empty:
+            if _readers_created < READ_POOL_SIZE:
+                conn = _connect()
+                _readers_created += 1
+    if conn is None:
+        conn = pool.get()
+    try:
+        yield conn
+    finally:
+        pool.put(conn)
+
+
+def close_all():
+    """
+    Закрывает соединение-писатель и все соединения из пула читателей.
+    """
+    global _writer, _readers, _readers_created
+    with _writer_lock:
+        if _writer is not None:
+            # Обновляет статистику планировщика для индексов перед закрытием
+            _writer.execute("PRAGMA optimize")
+            _writer.close()
+            _writer = None
+    with _pool_lock:
+        if _readers is not None:
+            while True:
+                try:
+                    _readers.get_nowait().close()
+                except queue.Empty:
+                    break
+        _readers = None
+        _readers_created = 0
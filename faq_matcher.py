@@ -0,0 +1,77 @@
+from collections import deque
+
+
+class FaqMatcher:
+    """
+    Автомат Ахо-Корасик по ключевым словам всех записей FAQ.
+    Сообщение просматривается за один линейный проход; если совпало несколько записей,
+    выигрывает запись с наименьшим приоритетом (порядковым номером в FAQ).
+    """
+
+    def __init__(self, faq_entries):
+        """
+        faq_entries — последовательность пар (ключевые слова через запятую, ответ)
+        в порядке приоритета.
+        """
+        self._answers = []
+        self._goto = [{}]
+        self._fail = [0]
+        # Лучший (минимальный) приоритет среди слов, оканчивающихся в узле, с учетом fail-ссылок
+        self._best = [None]
+
+        for priority, (keywords, answer) in enumerate(faq_entries):
+            self._answers.append(answer)
+            for keyword in keywords.split(','):
+                keyword = keyword.strip().lower()
+                if keyword:
+                    self._add_keyword(keyword, priority)
+        self._build_fail_links()
+
+    def _add_keyword(self, keyword: str, priority: int):
+        """Добавляет ключевое слово в бор."""
+        node = 0
+        for char in keyword:
+            next_node = self._goto[node].get(char)
+            if next_node is None:
+                next_node = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._best.append(None)
+                self._goto[node][char] = next_node
+            node = next_node
+        self._best[node] = self._min_priority(self._best[node], priority)
+
+    def _build_fail_links(self):
+        """Строит fail-ссылки обходом бора в ширину."""
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                fallback = self._fail[node]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[child] = self._goto[fallback].get(char, 0) if node else 0
+                self._best[child] = self._min_priority(self._best[child], self._best[self._fail[child]])
+                queue.append(child)
+
+    @staticmethod
+    def _min_priority(first, second):
+        """Возвращает меньший из двух приоритетов; None означает «совпадений нет»."""
+        if first is None:
+            return second
+        if second is None:
+            return first
+        return min(first, second)
+
+    def find_answer(self, message: str) -> str | None:
+        """Возвращает ответ самой приоритетной записи, ключевое слово которой встречается в сообщении."""
+        node = 0
+        best = None
+        for char in message.lower():
+            while node and char not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(char, 0)
+            best = self._min_priority(best, self._best[node])
+            if best == 0:
+                break
+        return self._answers[best] if best is not None else None
@@ -0,0 +1,95 @@
+import threading
+from collections import Counter
+
+# Счетчики по товарам: ID товара -> Counter {размер: число пар}.
+# Остатки (_stock) обновляет database.py после каждой записи в product_sizes,
+# брони (_holds) — reservation_store после записи в таблицу reservations.
+_stock = {}
+_holds = {}
+_lock = threading.Lock()
+
+
+def load_stock(rows):
+    """
+    Заменяет все остатки строками (ID товара, размер, количество) непроданных товаров.
+    """
+    with _lock:
+        _stock.clear()
+        for product_id, size, quantity in rows:
+            _stock.setdefault(product_id, Counter())[str(size)] = quantity
+
+
+def set_stock(product_id: int, counts: Counter):
+    """
+    Заменяет остатки товара; пустой Counter означает, что товара в продаже нет.
+    """
+    with _lock:
+        if counts:
+            _stock[product_id] = Counter({str(size): quantity for size, quantity in counts.items() if quantity > 0})
+        else:
+            _stock.pop(product_id, None)
+
+
+def hold(product_id: int, size, count: int = 1):
+    """Учитывает count забронированных пар размера size."""
+    with _lock:
+        _holds.setdefault(product_id, Counter())[str(size)] += count
+
+
+def release(product_id: int, size, count: int = 1):
+    """Снимает count броней размера size."""
+    size = str(size)
+    with _lock:
+        holds = _holds.get(product_id)
+        if not holds:
+            return
+        holds[size] -= count
+        if holds[size] <= 0:
+            del holds[size]
+        if not holds:
+            del _holds[product_id]
+
+
+def drop_product(product_id: int):
+    """Забывает остатки и брони удаленного товара."""
+    with _lock:
+        _stock.pop(product_id, None)
+        _holds.pop(product_id, None)
+
+
+def clear_holds():
+    """Сбрасывает все брони (перед загрузкой их из БД)."""
+    with _lock:
+        _holds.clear()
+
+
+def free(product_id: int, size) -> int:
+    """Возвращает число свободных (в наличии и не забронированных) пар размера size."""
+    size = str(size)
+    with _lock:
+        stock = _stock.get(product_id)
+        if not stock:
+            return 0
+        holds = _holds.get(product_id)
+        return max(0, stock[size] - (holds[size] if holds else 0))
+
+
+def size_sort_key(size: str):
+    """
+    Ключ сортировки размеров: числовые размеры сортируются как числа.
+    """
+    return (0, int(size), '') if size.isdigit() else (1, 0, size)
+
+
+def free_sizes(product_id: int) -> list[str]:
+    """Возвращает отсортированный список размеров товара, у которых есть свободные пары."""
+    with _lock:
+        available = Counter(_stock.get(product_id, ()))
+        available.subtract(_holds.get(product_id, ()))
+    return sorted(+available, key=size_sort_key)
+
+
+def held_sizes(product_id: int) -> list[str]:
+    """Возвращает забронированные размеры товара (размер повторяется по числу броней)."""
+    with _lock:
+        return list(_holds.get(product_id, Counter()).elements())
@@ -3,7 +3,9 @@ import json
 import uuid
 import re
 import logging
-from datetime import datetime, timedelta
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
 
 from apscheduler.jobstores.base import JobLookupError
 from telegram import (InlineKeyboardButton, InlineKeyboardMarkup, Update,
@@ -15,13 +17,26 @@ from telegram.ext import (Application, CommandHandler, ContextTypes,
 from config import (ADMIN_IDS, BOT_USERNAME, CHANNEL_ID, INSOLE_LENGTH_MAP,
                     PAYMENT_DETAILS, TELEGRAM_BOT_TOKEN, ORDERS_CHANNEL_ID,
                     DISPATCH_CHANNEL_ID)
-from database import (add_product, get_all_products, get_products_by_size, get_product_by_id, init_db,
-                      set_product_sold, update_message_id, update_product_price,
-                      update_product_sizes,
-                      delete_product_by_id, add_faq, get_all_faq, delete_faq_by_id, find_faq_by_keywords,
-                      get_chat_by_user_id, set_chat_status, delete_chat, add_message_to_history,
-                      get_history_for_user, get_chat_by_admin_id, add_or_update_customer,
-                      create_order, add_item_to_order)
+from async_database import (add_product, get_products_page, get_product_by_id,
+                            get_products_by_ids, decrement_stock_items, increment_stock, set_product_sold, update_message_id, update_product_price,
+                            update_product_sizes, search_products_by_size,
+                            delete_product_by_id, add_faq, get_all_faq, delete_faq_by_id, find_faq_by_keywords,
+                            get_chat_by_user_id, set_chat_status, claim_waiting_chat, delete_chat, add_message_to_history,
+                            get_history_for_user, get_chat_by_admin_id, place_order, flush_message_history,
+                            get_post_render_hash, save_post_render_hash)
+from async_database import shutdown as shutdown_db_executor
+from database import HISTORY_FLUSH_INTERVAL, init_db
+from db_connection import close_all as close_db_connections
+from post_renderer import render_channel_post, render_hash
+from post_updater import PostUpdater
+from rate_limiter import OutboundRateLimiter
+from reservation_expiry import PAID_HOLD_DURATION, SWEEP_INTERVAL, ExpiryQueue
+from update_processor import KeyedUpdateProcessor
+import inventory
+import metrics
+import product_cache
+import reservation_store
+import search_cache
 
 # Включаем логирование
 logging.basicConfig(
@@ -30,8 +45,6 @@ logging.basicConfig(
 logging.getLogger("httpx").setLevel(logging.WARNING)
 
 
-active_reservations = {}
-
 # Определяем состояния для диалога
 PHOTO, SELECTING_SIZES, ENTERING_PRICE, AWAITING_PROOF, AWAITING_NAME, AWAITING_PHONE, AWAITING_CITY, AWAITING_DELIVERY_CHOICE, AWAITING_NP_DETAILS, AWAITING_UP_DETAILS = range(10)
 SETTING_DETAILS = 10
@@ -46,7 +59,76 @@ async def reply_and_log(update: Update, text: str, **kwargs):
     """Отправляет ответ пользователю и логирует его в историю."""
     await update.message.reply_text(text, **kwargs)
     if update.effective_user:
-        add_message_to_history(user_id=update.effective_user.id, message_text=text, sender_type='bot')
+        await add_message_to_history(user_id=update.effective_user.id, message_text=text, sender_type='bot')
+
+
+async def refresh_channel_post(bot, product) -> None:
+    """
+    Перерисовывает пост товара в канале с учетом текущих броней.
+    Если подпись и клавиатура совпадают с уже опубликованными, редактирование пропускается.
+    """
+    caption, keyboard = render_channel_post(product, reservation_store.reserved_sizes(product['id']))
+    new_hash = render_hash(caption, keyboard)
+    message_id = product['message_id']
+    if await get_post_render_hash(message_id) == new_hash:
+        metrics.increment('channel_edits.skipped')
+        return
+
+    try:
+        await bot.edit_message_caption(
+            chat_id=CHANNEL_ID, message_id=message_id, caption=caption,
+            reply_markup=keyboard, parse_mode='HTML'
+        )
+        metrics.increment('channel_edits.sent')
+    except error.BadRequest as e:
+        if "Message is not modified" not in str(e):
+            raise
+        metrics.increment('channel_edits.skipped')
+    await save_post_render_hash(message_id, product['id'], new_hash)
+
+
+async def refresh_channel_posts(bot, product_ids) -> None:
+    """Перерисовывает посты нескольких товаров; вызывается фоновым PostUpdater."""
+    products = await get_products_by_ids(list(product_ids))
+    for product_id in product_ids:
+        product = products.get(product_id)
+        if not product or not product['message_id']:
+            print(f"Не удалось обновить пост: товар {product_id} или message_id не найден.")
+            continue
+        try:
+            await refresh_channel_post(bot, product)
+        except Exception as e:
+            print(f"Не удалось обновить пост товара {product_id} в канале: {e}")
+
+
+post_updater = PostUpdater(refresh_channel_posts)
+expiry_queue = ExpiryQueue()
+
+MEDIA_GROUP_LIMIT = 10
+
+
+async def send_product_media(bot, chat_id, file_ids, captions=None) -> None:
+    """
+    Отправляет фото/видео товаров альбомами по MEDIA_GROUP_LIMIT штук; альбомы уходят одновременно.
+    Одиночный файл отправляется обычным сообщением: альбом должен содержать от 2 элементов.
+    captions — необязательные подписи к каждому файлу.
+    """
+    captions = captions or [None] * len(file_ids)
+    sends = []
+    for start in range(0, len(file_ids), MEDIA_GROUP_LIMIT):
+        batch = list(zip(file_ids[start:start + MEDIA_GROUP_LIMIT], captions[start:start + MEDIA_GROUP_LIMIT]))
+        if len(batch) == 1:
+            file_id, caption = batch[0]
+            if file_id.startswith("BAAC"):
+                sends.append(bot.send_video(chat_id=chat_id, video=file_id, caption=caption))
+            else:
+                sends.append(bot.send_photo(chat_id=chat_id, photo=file_id, caption=caption))
+        else:
+            media = [InputMediaVideo(media=file_id, caption=caption) if file_id.startswith("BAAC")
+                     else InputMediaPhoto(media=file_id, caption=caption)
+                     for file_id, caption in batch]
+            sends.append(bot.send_media_group(chat_id=chat_id, media=media))
+    await asyncio.gather(*sends)
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -70,15 +152,13 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
                 await reply_and_log(update, "Некоректне посилання для покупки.")
                 return ConversationHandler.END
 
-            product = get_product_by_id(product_id)
+            product = await get_product_by_id(product_id)
             if not product or not product['sizes']:
                 await context.bot.send_message(chat_id=user_id, text="Вибачте, цей товар більше не доступний.")
                 return ConversationHandler.END
 
-            # Проверяем, доступен ли размер
-            available_sizes_list = product['sizes'].split(',')
-            reserved_for_this_product = active_reservations.get(product_id, [])
-            if selected_size not in available_sizes_list or available_sizes_list.count(selected_size) <= reserved_for_this_product.count(selected_size):
+            # Проверяем, есть ли свободная (не забронированная) пара этого размера
+            if inventory.free(product_id, selected_size) <= 0:
                 await context.bot.send_message(
                     chat_id=user_id,
                     text=f"Вибачте, розмір {selected_size} для цього товару більше не доступний або вже заброньований."
@@ -109,7 +189,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
                 await reply_and_log(update, "Некоректне посилання для покупки.")
                 return ConversationHandler.END
 
-            product = get_product_by_id(product_id)
+            product = await get_product_by_id(product_id)
             if not product or not product['sizes']:
                 await context.bot.send_message(chat_id=user_id, text="Вибачте, цей товар більше не доступний.")
                 return ConversationHandler.END
@@ -121,13 +201,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
             else:
                 await context.bot.send_photo(chat_id=user_id, photo=file_id)
 
-            # Создаем клавиатуру с доступными размерами
-            all_db_sizes = product['sizes'].split(',')
-            reserved_sizes = active_reservations.get(product_id, [])
-            available_sizes = list(all_db_sizes)
-            for r_size in reserved_sizes:
-                if r_size in available_sizes:
-                    available_sizes.remove(r_size)
+            # Создаем клавиатуру со свободными размерами
+            available_sizes = inventory.free_sizes(product_id)
 
             if not available_sizes:
                 await context.bot.send_message(
@@ -246,7 +321,7 @@ async def select_size_callback(update: Update, context: ContextTypes.DEFAULT_TYP
 
 async def price_received(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Обрабатывает цену, публикует товар в канал и завершает диалог."""
-    add_message_to_history(user_id=update.effective_user.id, message_text=update.message.text, sender_type='user')
+    await add_message_to_history(user_id=update.effective_user.id, message_text=update.message.text, sender_type='user')
     price_text = update.message.text
     if not price_text.isdigit():
         await reply_and_log(update, "Будь ласка, введіть коректну ціну у вигляді числа.")
@@ -266,26 +341,14 @@ async def price_received(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     insole_lengths_json = json.dumps(insole_lengths)
 
     # Добавляем товар в базу и получаем его ID
-    product_id = add_product(
+    product_id = await add_product(
         file_id=file_id, price=price, sizes=selected_sizes,
         insole_lengths_json=insole_lengths_json
     )
 
     # Готовим пост для канала
-    formatted_sizes = []
-    for size in sorted(selected_sizes):
-        length = insole_lengths.get(size)
-        if length is not None:
-            formatted_sizes.append(f"<b>{size}</b> ({length} см)")
-        else:
-            formatted_sizes.append(f"<b>{size}</b>")
-    sizes_str = ", ".join(formatted_sizes)
-    caption = (f"Натуральна шкіра\n"
-               f"{sizes_str} розмір\n"
-               f"{price} грн наявність")
-    keyboard = InlineKeyboardMarkup(
-        [[InlineKeyboardButton("🛒 Купити", url=f"https://t.me/{BOT_USERNAME}?start=buy_{product_id}")]]
-    )
+    product = await get_product_by_id(product_id)
+    caption, keyboard = render_channel_post(product)
 
     # Отправляем пост в канал, определяя тип медиа
     if file_id.startswith("BAAC"):  # Примерный префикс для видео
@@ -297,46 +360,87 @@ async def price_received(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             chat_id=CHANNEL_ID, photo=file_id, caption=caption, reply_markup=keyboard, parse_mode='HTML'
         )
 
-    # Сохраняем message_id в базу
-    update_message_id(product_id, sent_message.message_id)
+    # Сохраняем message_id и хэш опубликованного поста в базу
+    await update_message_id(product_id, sent_message.message_id)
+    await save_post_render_hash(sent_message.message_id, product_id, render_hash(caption, keyboard))
 
     await reply_and_log(update, "Товар успішно додано та опубліковано в каналі.")
     return ConversationHandler.END
 
 
-async def show_catalog(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Выводит каталог товаров, доступных для покупки."""
-    products = get_all_products()
+# Режимы постраничного списка товаров: каталог и удаление
+CATALOG_MODE = 'c'
+DELETE_MODE = 'd'
+CATALOG_BUTTONS_PER_ROW = 4
+
 
+async def send_catalog_page(bot, chat_id, mode: str, is_admin: bool, after_id: int = 0,
+                            before_id: int | None = None) -> bool:
+    """
+    Отправляет страницу каталога: альбом с фото/видео товаров, пронумерованных по порядку,
+    и сообщение со списком, кнопками действий и навигацией ⬅️/➡️.
+    Возвращает False, если на странице нет товаров.
+    """
+    products, has_prev, has_next = await get_products_page(after_id, before_id)
     if not products:
-        await reply_and_log(update, "Каталог поки що порожній.")
-        return
+        return False
 
-    for product in products:
-        caption = f"Ціна: {product['price']} грн.\nРозміри в наявності: {product['sizes']}"
+    await send_product_media(bot, chat_id, [product['file_id'] for product in products],
+                             captions=[f"№{number}" for number in range(1, len(products) + 1)])
 
-        is_admin = update.effective_user.id in ADMIN_IDS
-        if is_admin:
-            keyboard = InlineKeyboardMarkup([
-                [
-                    InlineKeyboardButton("📝 Редагувати", callback_data=f"edit_{product['id']}"),
-                    InlineKeyboardButton("🔁 Опублікувати", callback_data=f"repub_{product['id']}")
-                ]
-            ])
+    lines = []
+    buttons = []
+    for number, product in enumerate(products, start=1):
+        if mode == DELETE_MODE:
+            lines.append(f"№{number} — ID: {product['id']}, {product['price']} грн., розміри: {product['sizes']}")
+            buttons.append(InlineKeyboardButton(f"❌ №{number}", callback_data=f"del_{product['id']}"))
         else:
-            keyboard = InlineKeyboardMarkup(
-                [[InlineKeyboardButton("🛒 Купити", url=f"https://t.me/{BOT_USERNAME}?start=buy_{product['id']}")]]
-            )
+            lines.append(f"№{number} — {product['price']} грн., розміри в наявності: {product['sizes']}")
+            if is_admin:
+                buttons.append(InlineKeyboardButton(f"📝 №{number}", callback_data=f"edit_{product['id']}"))
+                buttons.append(InlineKeyboardButton(f"🔁 №{number}", callback_data=f"repub_{product['id']}"))
+            else:
+                buttons.append(InlineKeyboardButton(
+                    f"🛒 №{number}", url=f"https://t.me/{BOT_USERNAME}?start=buy_{product['id']}"))
 
-        # Отправляем медиа в зависимости от его типа
-        if product['file_id'].startswith("BAAC"):
-            await update.message.reply_video(
-                video=product['file_id'], caption=caption, reply_markup=keyboard
-            )
-        else:
-            await update.message.reply_photo(
-                photo=product['file_id'], caption=caption, reply_markup=keyboard
-            )
+    keyboard_rows = [buttons[i:i + CATALOG_BUTTONS_PER_ROW] for i in range(0, len(buttons), CATALOG_BUTTONS_PER_ROW)]
+    navigation_row = []
+    if has_prev:
+        navigation_row.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"catalog_page_{mode}_b_{products[0]['id']}"))
+    if has_next:
+        navigation_row.append(InlineKeyboardButton("Далі ➡️", callback_data=f"catalog_page_{mode}_a_{products[-1]['id']}"))
+    if navigation_row:
+        keyboard_rows.append(navigation_row)
+
+    await bot.send_message(chat_id=chat_id, text="\n".join(lines), reply_markup=InlineKeyboardMarkup(keyboard_rows))
+    return True
+
+
+async def show_catalog(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Выводит первую страницу каталога товаров, доступных для покупки."""
+    is_admin = update.effective_user.id in ADMIN_IDS
+    if not await send_catalog_page(context.bot, update.effective_chat.id, CATALOG_MODE, is_admin):
+        await reply_and_log(update, "Каталог поки що порожній.")
+
+
+async def catalog_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Показывает соседнюю страницу каталога или списка удаления (формат: catalog_page_{режим}_{a|b}_{id})."""
+    query = update.callback_query
+    _, _, mode, direction, product_id_str = query.data.split('_')
+    is_admin = update.effective_user.id in ADMIN_IDS
+    if mode == DELETE_MODE and not is_admin:
+        await query.answer("Ця дія доступна лише адміністратору.", show_alert=True)
+        return
+    await query.answer()
+
+    if direction == 'a':
+        page_sent = await send_catalog_page(context.bot, query.message.chat.id, mode, is_admin,
+                                            after_id=int(product_id_str))
+    else:
+        page_sent = await send_catalog_page(context.bot, query.message.chat.id, mode, is_admin,
+                                            before_id=int(product_id_str))
+    if not page_sent:
+        await query.message.reply_text("Більше товарів не знайдено.")
 
 
 async def size_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -349,7 +453,7 @@ async def size_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     product_id = int(product_id_str)
 
     # Шаг 1.1: Получаем информацию о товаре
-    product = get_product_by_id(product_id)
+    product = await get_product_by_id(product_id)
     if not product:
         await query.edit_message_text("Помилка: товар не знайдено.")
         return
@@ -407,11 +511,12 @@ async def checkout_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
     summary_lines = []
     total_price = 0
     keyboard_rows = []
+    products = await get_products_by_ids([item['product_id'] for item in cart])
 
     for index, item in enumerate(cart):
         product_id = item['product_id']
         size = item['size']
-        product = get_product_by_id(product_id)
+        product = products.get(product_id)
 
         if product:
             # В базе нет названия, используем ID для идентификации
@@ -491,68 +596,20 @@ async def payment_cart_callback(update: Update, context: ContextTypes.DEFAULT_TY
         await query.edit_message_text("Ваш кошик порожній.")
         return ConversationHandler.END
 
-    reserved_items = []
-    # Предварительная проверка доступности всех товаров в корзине
-    for item in cart:
-        product_id = item['product_id']
-        selected_size = item['size']
-        product = get_product_by_id(product_id)
-        if not product:
+    products = await get_products_by_ids([item['product_id'] for item in cart])
+    # Предварительная проверка доступности всех товаров в корзине: сколько пар каждого размера нужно
+    # и сколько их свободно с учетом уже существующих броней
+    cart_counts = Counter((item['product_id'], item['size']) for item in cart)
+    for (product_id, selected_size), num_in_cart in cart_counts.items():
+        if product_id not in products:
             await query.edit_message_text(f"Помилка: товар ID {product_id} не знайдено.")
             return ConversationHandler.END
 
-        available_sizes_list = product['sizes'].split(',')
-        reserved_for_this_product = active_reservations.get(product_id, [])
-
-        # Считаем, сколько единиц этого размера уже в корзине
-        num_in_cart = sum(1 for i in cart if i['product_id'] == product_id and i['size'] == selected_size)
-        # Считаем, сколько доступно в БД с учетом уже существующих броней
-        num_available_in_db = available_sizes_list.count(selected_size)
-        num_already_reserved = reserved_for_this_product.count(selected_size)
-
-        if num_in_cart > (num_available_in_db - num_already_reserved):
+        if num_in_cart > inventory.free(product_id, selected_size):
             await query.edit_message_text(f"Вибачте, товару ID {product_id} розміру {selected_size} недостатньо в наявності для вашого замовлення.")
             return ConversationHandler.END
     print("--- [CART_DEBUG] Шаг 2: Предварительная проверка наличия всех товаров пройдена ---")
 
-    # Если все товары доступны, начинаем бронирование и обновление постов
-    for item in cart:
-        product_id = item['product_id']
-        selected_size = item['size']
-        print(f"--- [CART_DEBUG] Шаг 3: Бронирую товар {item['product_id']}, размер {item['size']} ---")
-
-        # Регистрируем бронь
-        active_reservations.setdefault(product_id, []).append(selected_size)
-        reserved_items.append({'product_id': product_id, 'size': selected_size})
-
-        # Обновляем пост в канале
-        product = get_product_by_id(product_id)
-        if not product or not product['message_id']:
-            continue
-
-        all_db_sizes_list = product['sizes'].split(',')
-        all_reserved_sizes_list = active_reservations.get(product_id, [])
-        final_available_sizes_list = list(all_db_sizes_list)
-        for r_size in all_reserved_sizes_list:
-            if r_size in final_available_sizes_list:
-                final_available_sizes_list.remove(r_size)
-        final_available_sizes = sorted(final_available_sizes_list, key=int)
-
-        try:
-            if final_available_sizes:
-                insole_lengths = json.loads(product['insole_lengths_json']) if product['insole_lengths_json'] else {}
-                formatted_sizes = [f"<b>{s}</b> ({insole_lengths.get(s)} см)" if insole_lengths.get(s) else f"<b>{s}</b>" for s in final_available_sizes]
-                new_sizes_str = ", ".join(formatted_sizes)
-                new_caption = (f"Натуральна шкіра\n{new_sizes_str} розмір\n{product['price']} грн наявність")
-                keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("🛒 Купити", url=f"https://t.me/{BOT_USERNAME}?start=buy_{product['id']}")]])
-                await context.bot.edit_message_caption(chat_id=CHANNEL_ID, message_id=product['message_id'], caption=new_caption, reply_markup=keyboard, parse_mode='HTML')
-            else:
-                new_caption = (f"Натуральна шкіра\nПРОДАНО\n{product['price']} грн наявність")
-                await context.bot.edit_message_caption(chat_id=CHANNEL_ID, message_id=product['message_id'], caption=new_caption, reply_markup=None)
-        except Exception as e:
-            print(f"Не удалось отредактировать сообщение в канале при бронировании корзины: {e}")
-    print("--- [CART_DEBUG] Шаг 4: Все товары забронированы, посты в канале обновлены ---")
-
     # Определяем длительность брони и текст сообщения
     now = datetime.now()
     if 10 <= now.hour < 19:
@@ -564,8 +621,18 @@ async def payment_cart_callback(update: Update, context: ContextTypes.DEFAULT_TY
         reservation_duration = (ten_am_tomorrow - now).total_seconds()
         user_message = f"Реквізити для оплати:\n(натисніть на номер нижче, щоб скопіювати)\n<code>{PAYMENT_DETAILS}</code>\n\nТовари тимчасово заброньовано до 10:00 ранку. Надішліть, будь ласка, скріншот або файл, що підтверджує оплату, до цього часу. В іншому випадку бронь буде скасована, і товари знову стануть доступними для продажу."
 
-    job = context.job_queue.run_once(cancel_reservation, reservation_duration, data={'user_id': user_id, 'reserved_items': reserved_items}, name=f"reservation_cart_{user_id}")
-    context.user_data['reservation_job'] = job
+    # Если все товары доступны, бронируем их до истечения срока и ставим посты в очередь на обновление
+    reserved_items = [{'product_id': item['product_id'], 'size': item['size']} for item in cart]
+    print(f"--- [CART_DEBUG] Шаг 3: Бронирую товары {reserved_items} ---")
+    expires_at = datetime.now(timezone.utc) + timedelta(seconds=reservation_duration)
+    if not await reservation_store.reserve(user_id, reserved_items, expires_at):
+        await query.edit_message_text("Вибачте, поки ви оформлювали замовлення, частину товарів уже забронювали. Перевірте, будь ласка, кошик.")
+        return ConversationHandler.END
+    for item in reserved_items:
+        post_updater.notify(item['product_id'])
+    print("--- [CART_DEBUG] Шаг 4: Все товары забронированы, посты в канале поставлены в очередь на обновление ---")
+
+    expiry_queue.schedule(user_id, expires_at)
     context.user_data['cart_items_for_confirmation'] = reserved_items
     await query.edit_message_reply_markup(reply_markup=None)
     await query.message.reply_text(user_message, parse_mode='HTML')
@@ -575,79 +642,44 @@ async def payment_cart_callback(update: Update, context: ContextTypes.DEFAULT_TY
 
 
 
-async def cancel_reservation(context: ContextTypes.DEFAULT_TYPE) -> None:
+async def expire_reservations_job(context: ContextTypes.DEFAULT_TYPE) -> None:
     """
-    Отменяет визуальную бронь, возвращая посту в канале исходное состояние. Работает как для одиночных товаров, так и для корзины.
+    Периодически снимает истекшие брони одной пачкой: освобождает размеры, ставит посты всех
+    затронутых товаров в общую очередь обновления и уведомляет клиентов.
     """
-    job_data = context.job.data
-    user_id = job_data['user_id']
-
-    items_to_process = []
-    is_cart_reservation = 'reserved_items' in job_data
-
-    if is_cart_reservation:
-        items_to_process.extend(job_data['reserved_items'])
-        user_notification_text = "На жаль, час на оплату замовлення вичерпано. Ваша бронь скасовано. Товари знову доступні для покупки."
-    else:  # Старая логика для одного товара
-        items_to_process.append({'product_id': job_data['product_id'], 'selected_size': job_data['selected_size']})
-        user_notification_text = f"На жаль, час на оплату товару (ID: {job_data['product_id']}, розмір: {job_data['selected_size']}) вичерпано. Ваша бронь скасовано. Товар знову доступний для покупки."
-
-    updated_posts = set()
-
-    for item in items_to_process:
-        product_id = item['product_id']
-        selected_size = item['selected_size']
-
-        # Снимаем бронь из временного хранилища
-        if product_id in active_reservations and selected_size in active_reservations.get(product_id, []):
-            active_reservations[product_id].remove(selected_size)
-            if not active_reservations[product_id]:
-                del active_reservations[product_id]
-
-        if product_id in updated_posts:
-            continue
-
-        product = get_product_by_id(product_id)
-        if not product or not product['message_id']:
-            print(f"Ошибка отмены брони: товар {product_id} или message_id не найден.")
-            continue
-
-        # Восстанавливаем подпись в посте канала, учитывая другие активные брони
-        all_db_sizes_list = product['sizes'].split(',')
-        all_current_reserved_sizes_list = active_reservations.get(product_id, [])
-
-        final_available_sizes_list = list(all_db_sizes_list)
-        for r_size in all_current_reserved_sizes_list:
-            if r_size in final_available_sizes_list:
-                final_available_sizes_list.remove(r_size)
-
-        final_available_sizes = sorted(final_available_sizes_list, key=int)
+    now = datetime.now(timezone.utc)
+    if not expiry_queue.pop_due(now):
+        return
 
-        insole_lengths = json.loads(product['insole_lengths_json']) if product['insole_lengths_json'] else {}
-        formatted_sizes = [f"<b>{s}</b> ({insole_lengths.get(s)} см)" if insole_lengths.get(s) else f"<b>{s}</b>" for s in final_available_sizes]
-        new_sizes_str = ", ".join(formatted_sizes)
-        new_caption = (f"Натуральна шкіра\n{new_sizes_str} розмір\n{product['price']} грн наявність")
-        keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("🛒 Купити", url=f"https://t.me/{BOT_USERNAME}?start=buy_{product['id']}")]])
+    # Брони, которые уже сняты (например, заказ подтвержден), в выборку не попадут
+    expired_items = await reservation_store.expire(now)
+    if not expired_items:
+        return
+    metrics.increment('reservations.expired', len(expired_items))
 
-        try:
-            await context.bot.edit_message_caption(
-                chat_id=CHANNEL_ID, message_id=product['message_id'], caption=new_caption,
-                reply_markup=keyboard, parse_mode='HTML'
-            )
-            updated_posts.add(product_id)
-        except Exception as e:
-            print(f"Не удалось обновить сообщение в канале при отмене брони: {e}")
+    # Восстанавливаем подписи в постах канала, учитывая другие активные брони
+    for product_id in {item['product_id'] for item in expired_items}:
+        post_updater.notify(product_id)
 
-    await context.bot.send_message(chat_id=user_id, text=user_notification_text)
+    user_ids = list(dict.fromkeys(item['user_id'] for item in expired_items))
+    user_notification_text = "На жаль, час на оплату замовлення вичерпано. Ваша бронь скасовано. Товари знову доступні для покупки."
+    results = await asyncio.gather(
+        *(context.bot.send_message(chat_id=user_id, text=user_notification_text) for user_id in user_ids),
+        return_exceptions=True
+    )
+    for user_id, result in zip(user_ids, results):
+        if isinstance(result, Exception):
+            logging.warning(f"Не удалось уведомить клиента {user_id} об отмене брони: {result}")
 
 
 async def proof_received(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Принимает подтверждение оплаты, отменяет таймер и запрашивает ФИО."""
-    # Отменяем таймер отмены брони
-    job = context.user_data.get('reservation_job')
-    if job:
-        job.schedule_removal()
-        print(f"Таймер брони {job.name} отменен.")
+    """Принимает подтверждение оплаты, продлевает бронь и запрашивает ФИО."""
+    # Продлеваем брони клиента: они держатся до подтверждения заказа менеджером, но не дольше PAID_HOLD_DURATION
+    user_id = update.effective_user.id
+    expires_at = datetime.now(timezone.utc) + timedelta(seconds=PAID_HOLD_DURATION)
+    await reservation_store.extend(user_id, expires_at)
+    expiry_queue.cancel(user_id)
+    expiry_queue.schedule(user_id, expires_at)
 
     file_id = None
     if update.message.photo:
@@ -667,7 +699,7 @@ async def proof_received(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
 async def name_received(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Сохраняет ФИО и запрашивает номер телефона."""
-    add_message_to_history(user_id=update.effective_user.id, message_text=update.message.text, sender_type='user')
+    await add_message_to_history(user_id=update.effective_user.id, message_text=update.message.text, sender_type='user')
     context.user_data['full_name'] = update.message.text
     await reply_and_log(update, "Введіть Ваш номер телефону.")
     return AWAITING_PHONE
@@ -675,7 +707,7 @@ async def name_received(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
 
 async def phone_received(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Сохраняет телефон и запрашивает город."""
-    add_message_to_history(user_id=update.effective_user.id, message_text=update.message.text, sender_type='user')
+    await add_message_to_history(user_id=update.effective_user.id, message_text=update.message.text, sender_type='user')
     context.user_data['phone_number'] = update.message.text
     await reply_and_log(update, "Введіть Ваше місто.")
     return AWAITING_CITY
@@ -683,7 +715,7 @@ async def phone_received(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
 async def city_received(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Сохраняет город и предлагает выбрать способ доставки."""
-    add_message_to_history(user_id=update.effective_user.id, message_text=update.message.text, sender_type='user')
+    await add_message_to_history(user_id=update.effective_user.id, message_text=update.message.text, sender_type='user')
     context.user_data['city'] = update.message.text
     keyboard = InlineKeyboardMarkup([
         [InlineKeyboardButton("Нова Пошта", callback_data='delivery_np')],
@@ -714,7 +746,7 @@ async def delivery_details_received(update: Update, context: ContextTypes.DEFAUL
     Сохраняет детали доставки, собирает все данные по корзине, отправляет заказ менеджеру
     и завершает диалог.
     """
-    add_message_to_history(user_id=update.effective_user.id, message_text=update.message.text, sender_type='user')
+    await add_message_to_history(user_id=update.effective_user.id, message_text=update.message.text, sender_type='user')
     context.user_data['delivery_final_detail'] = update.message.text
     user_id = update.effective_user.id
 
@@ -732,31 +764,27 @@ async def delivery_details_received(update: Update, context: ContextTypes.DEFAUL
     delivery_method = user_data.get('delivery_method')
     delivery_final_detail = user_data.get('delivery_final_detail')
     
-    # --- Сохранение заказа в CRM ---
-    # Шаг А: Сохранение/обновление данных о клиенте
-    add_or_update_customer(user_id=user_id, full_name=full_name, phone_number=phone_number)
+    products = await get_products_by_ids([item['product_id'] for item in cart])
 
-    # Шаг Б: Создание заказа
+    # --- Сохранение заказа в CRM ---
+    # Клиент, заказ и его товары записываются одной транзакцией
     full_address = f"{city}, {delivery_method}, {delivery_final_detail}"
-    new_order_id = create_order(customer_user_id=user_id, delivery_address=full_address, status="Новый")
-
-    # Шаг В: Сохранение товаров в заказе
-    for item in cart:
-        product = get_product_by_id(item['product_id'])
-        if product:
-            add_item_to_order(
-                order_id=new_order_id,
-                product_id=item['product_id'],
-                size=str(item['size']),
-                price_at_purchase=product['price']
-            )
+    await place_order(
+        customer={'user_id': user_id, 'full_name': full_name, 'phone_number': phone_number},
+        delivery_address=full_address,
+        items=[
+            {'product_id': item['product_id'], 'size': item['size'],
+             'price_at_purchase': products[item['product_id']]['price']}
+            for item in cart if item['product_id'] in products
+        ]
+    )
     # --- Конец блока CRM ---
 
     # 2. Сформировать "карточку заказа" для менеджера
     order_items_text_lines = []
     total_price = 0
     for item in cart:
-        product = get_product_by_id(item['product_id'])
+        product = products.get(item['product_id'])
         if product:
             price = product['price']
             total_price += price
@@ -789,18 +817,13 @@ async def delivery_details_received(update: Update, context: ContextTypes.DEFAUL
     ])
 
     # 3. Отправить заказ менеджеру
-    # Сначала все фото/видео товаров
-    for item in cart:
-        product = get_product_by_id(item['product_id'])
-        if product:
-            product_file_id = product['file_id']
-            if product_file_id.startswith("BAAC"):
-                await context.bot.send_video(chat_id=ORDERS_CHANNEL_ID, video=product_file_id)
-            else:
-                await context.bot.send_photo(chat_id=ORDERS_CHANNEL_ID, photo=product_file_id)
-
-    # Затем подтверждение оплаты и детали заказа
-    await context.bot.send_photo(chat_id=ORDERS_CHANNEL_ID, photo=proof_file_id, caption="Підтвердження оплати від клієнта")
+    # Альбом с фото/видео товаров и подтверждение оплаты отправляются одновременно
+    product_file_ids = [products[item['product_id']]['file_id'] for item in cart if item['product_id'] in products]
+    await asyncio.gather(
+        send_product_media(context.bot, ORDERS_CHANNEL_ID, product_file_ids),
+        context.bot.send_photo(chat_id=ORDERS_CHANNEL_ID, photo=proof_file_id, caption="Підтвердження оплати від клієнта"),
+    )
+    # Затем детали заказа
     await context.bot.send_message(chat_id=ORDERS_CHANNEL_ID, text=order_details, reply_markup=keyboard, parse_mode='HTML')
 
     await reply_and_log(update,
@@ -829,63 +852,59 @@ async def confirm_order_callback(update: Update, context: ContextTypes.DEFAULT_T
         await query.edit_message_text("Помилка: Некоректні дані в кнопці.")
         return
 
-    # 2. Извлечь корзину из bot_data, не удаляя ее
+    # 2. Извлечь корзину из bot_data, не удаляя ее. Между проверкой флага подтверждения и его установкой
+    # нет await, поэтому повторное нажатие или второй менеджер не спишут товары заказа еще раз
     cart = context.bot_data.get(order_id)
     print(f"--- [CONFIRM_DEBUG] Шаг 3: Прочитана корзина (без удаления): {cart} ---")
-    if not cart:
+    if not cart or context.bot_data.get(f"confirmed_{order_id}"):
         await query.answer("Це замовлення вже було оброблено або не знайдено.", show_alert=True)
         # Обновляем сообщение, чтобы убрать кнопку и показать, что обработано
         new_text = query.message.text + "\n\n<b>⚠️ ЗАМОВЛЕННЯ ВЖЕ ОБРОБЛЕНО</b>"
         await query.edit_message_text(text=new_text, reply_markup=None, parse_mode='HTML')
         return
-
-    # 3. Обработать каждый товар в корзине
-    for item in cart:
-        print(f"--- [CONFIRM_DEBUG] Шаг 4: Обрабатываю товар {item} ---")
-        product_id = item['product_id']
-        selected_size = item['size']
-
-        # Удаляем размер из БД
-        product = get_product_by_id(product_id)
-        if product:
-            current_sizes = product['sizes'].split(',')
-            if selected_size in current_sizes:
-                current_sizes.remove(selected_size)
-                new_sizes_str = ",".join(sorted(current_sizes, key=int))
-                update_product_sizes(product_id, new_sizes_str)
-            else:
-                print(f"Предупреждение: Размер {selected_size} для товара {product_id} не найден в БД при подтверждении заказа.")
-
-        # Снимаем бронь из временного хранилища
-        if product_id in active_reservations and selected_size in active_reservations.get(product_id, []):
-            active_reservations[product_id].remove(selected_size)
-            if not active_reservations[product_id]:
-                del active_reservations[product_id]
-    print(f"Брони сняты после подтверждения заказа {order_id}: {active_reservations}")
+    context.bot_data[f"confirmed_{order_id}"] = True
+
+    # 3. Списать товары корзины одной транзакцией: условное списание безопасно при одновременных подтверждениях
+    print(f"--- [CONFIRM_DEBUG] Шаг 4: Списываю товары {cart} ---")
+    decremented = await decrement_stock_items(cart)
+    missing_items = []
+    for item, success in zip(cart, decremented):
+        if not success:
+            print(f"Предупреждение: Размер {item['size']} для товара {item['product_id']} не найден в БД при подтверждении заказа.")
+            missing_items.append(item)
+        post_updater.notify(item['product_id'])
+    missing_note = ""
+    if missing_items:
+        missing_lines = "\n".join(f"• ID {item['product_id']}, розмір {item['size']}" for item in missing_items)
+        missing_note = f"\n\n<b>⚠️ Не вдалося списати зі складу (немає в наявності):</b>\n{missing_lines}\nПеревірте наявність перед відправкою."
+
+    # Снимаем брони клиента с подтвержденных товаров
+    released = await reservation_store.release(user_id, [{'product_id': item['product_id'], 'size': item['size']} for item in cart])
+    print(f"Брони сняты после подтверждения заказа {order_id}: {released}")
 
     # 4. Уведомить клиента
-    try:
-        await context.bot.send_message(
-            chat_id=user_id,
-            text="Ваше замовлення прийнято в обробку. Як тільки посилку буде відправлено, ми повідомимо вам номер ТТН."
-        )
-    except Exception as e:
-        print(f"Не удалось отправить уведомление клиенту {user_id}: {e}")
+    async def notify_customer():
+        try:
+            await context.bot.send_message(
+                chat_id=user_id,
+                text="Ваше замовлення прийнято в обробку. Як тільки посилку буде відправлено, ми повідомимо вам номер ТТН."
+            )
+        except Exception as e:
+            print(f"Не удалось отправить уведомление клиенту {user_id}: {e}")
 
     # 5. Пересылаем подтвержденный заказ в канал для отправок
     print("--- [CONFIRM_DEBUG] Шаг 5: Готовлюсь к отправке в канал 'Отправки' ---")
     try:
-        # Сначала отправляем фото/видео каждого товара
+        # Уведомление клиента и альбом с фото/видео товаров отправляются одновременно
+        products = await get_products_by_ids([item['product_id'] for item in cart])
+        product_file_ids = []
         for item in cart:
-            product = get_product_by_id(item['product_id'])
+            product = products.get(item['product_id'])
             if product:
-                product_file_id = product['file_id']
-                if product_file_id.startswith("BAAC"):
-                    await context.bot.send_video(chat_id=DISPATCH_CHANNEL_ID, video=product_file_id)
-                else:
-                    await context.bot.send_photo(chat_id=DISPATCH_CHANNEL_ID, photo=product_file_id)
+                product_file_ids.append(product['file_id'])
             else:
                 print(f"--- [CONFIRM_DEBUG] Товар {item['product_id']} не найден в БД для отправки фото в канал 'Отправки'")
+        await asyncio.gather(notify_customer(), send_product_media(context.bot, DISPATCH_CHANNEL_ID, product_file_ids))
 
         original_order_text = query.message.text
         dispatch_text = (
@@ -893,14 +912,15 @@ async def confirm_order_callback(update: Update, context: ContextTypes.DEFAULT_T
             f"{original_order_text}\n\n"
             f"<b>ID Замовлення:</b> <code>{order_id}</code>\n"
             f"<b>ID Клієнта для ТТН:</b> <code>{user_id}</code>"
+            f"{missing_note}"
         )
         await context.bot.send_message(chat_id=DISPATCH_CHANNEL_ID, text=dispatch_text, parse_mode='HTML')
     except Exception as e:
         print(f"Не удалось отправить заказ в канал для отправок: {e}")
         print(f"--- [CONFIRM_DEBUG] ОШИБКА при отправке в канал 'Отправки': {e} ---")
 
-    # 6. Обновить сообщение для менеджера
-    new_text = query.message.text + "\n\n<b>✅ ЗАМОВЛЕННЯ ПІДТВЕРДЖЕНО</b>"
+    # 6. Обновить сообщение для менеджера; товары, которые не удалось списать, нужно проверить вручную
+    new_text = query.message.text + "\n\n<b>✅ ЗАМОВЛЕННЯ ПІДТВЕРДЖЕНО</b>" + missing_note
     await query.edit_message_text(text=new_text, reply_markup=None, parse_mode='HTML')
 
 
@@ -997,6 +1017,7 @@ async def handle_order_status_callback(update: Update, context: ContextTypes.DEF
 
         # Шаг 2.2: Получаем и сразу удаляем заказ из памяти
         cart = context.bot_data.pop(order_id, None)
+        context.bot_data.pop(f"confirmed_{order_id}", None)
 
         # Шаг 2.3: Проверяем, был ли заказ найден/уже обработан
         if not cart:
@@ -1020,39 +1041,12 @@ async def handle_order_status_callback(update: Update, context: ContextTypes.DEF
                 size = item['size']
                 print(f"--- [DEBUG] Возвращаю товар ID: {product_id}, Размер: {size} ---")
 
-                product = get_product_by_id(product_id)
-                if not product:
+                if not await increment_stock(product_id, size):
                     print(f"--- [DEBUG] ОШИБКА: Товар {product_id} не найден в базе данных. ---")
                     continue
 
-                current_sizes = product['sizes'].split(',') if product['sizes'] else []
-                current_sizes.append(size)
-                new_sizes_str = ",".join(sorted(current_sizes, key=int))
-                update_product_sizes(product_id, new_sizes_str)
-                print(f"--- [DEBUG] База данных для товара {product_id} обновлена. Новые размеры: '{new_sizes_str}' ---")
-
-                updated_product = get_product_by_id(product_id)
-                if updated_product and updated_product['message_id']:
-                    print(f"--- [DEBUG] Пытаюсь обновить пост в канале. Message ID: {updated_product['message_id']} ---")
-                    try:
-                        all_sizes = sorted(updated_product['sizes'].split(','), key=int)
-                        insole_lengths = json.loads(updated_product['insole_lengths_json']) if updated_product['insole_lengths_json'] else {}
-                        formatted_sizes = [f"<b>{s}</b> ({insole_lengths.get(s)} см)" if insole_lengths.get(s) else f"<b>{s}</b>" for s in all_sizes]
-                        sizes_str = ", ".join(formatted_sizes)
-                        new_caption = (f"Натуральна шкіра\n"
-                                       f"{sizes_str} розмір\n"
-                                       f"{updated_product['price']} грн наявність")
-                        keyboard = InlineKeyboardMarkup([
-                            [InlineKeyboardButton("🛒 Купити", url=f"https://t.me/{BOT_USERNAME}?start=buy_{product_id}")]
-                        ])
-                        await context.bot.edit_message_caption(
-                            chat_id=CHANNEL_ID, message_id=updated_product['message_id'], caption=new_caption, reply_markup=keyboard, parse_mode='HTML'
-                        )
-                        print(f"--- [DEBUG] Пост для товара {product_id} успешно обновлен. ---")
-                    except Exception as e:
-                        print(f"--- [DEBUG] КРИТИЧЕСКАЯ ОШИБКА при обновлении поста в канале: {e} ---")
-                else:
-                    print(f"--- [DEBUG] ОШИБКА: Не найден message_id для товара {product_id}, не могу обновить пост. ---")
+                print(f"--- [DEBUG] База данных для товара {product_id} обновлена: размер {size} возвращен в наличие. ---")
+                post_updater.notify(product_id)
 
             final_text_addition = "\n\n↩️ <b>ВІДМОВА. ТОВАРИ ПОВЕРНЕНО В БАЗУ ДАНИХ</b>"
 
@@ -1081,30 +1075,14 @@ async def republish_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
         product_id = int(query.data.split('_')[1])
         print(f"Received product_id: {product_id}")
-        product = get_product_by_id(product_id)
+        product = await get_product_by_id(product_id)
 
         if not product:
             await query.edit_message_text("Помилка: товар не знайдено.")
             return
 
         # Формируем подпись и клавиатуру для поста в канале
-        original_sizes = sorted(product['sizes'].split(','), key=int)
-        insole_lengths = json.loads(product['insole_lengths_json']) if product['insole_lengths_json'] else {}
-
-        formatted_sizes = []
-        for size in original_sizes:
-            length = insole_lengths.get(size)
-            if length is not None:
-                formatted_sizes.append(f"<b>{size}</b> ({length} см)")
-            else:
-                formatted_sizes.append(f"<b>{size}</b>")
-        sizes_str = ", ".join(formatted_sizes)
-        caption = (f"Натуральна шкіра\n"
-                   f"{sizes_str} розмір\n"
-                   f"{product['price']} грн наявність")
-        keyboard = InlineKeyboardMarkup(
-            [[InlineKeyboardButton("🛒 Купити", url=f"https://t.me/{BOT_USERNAME}?start=buy_{product_id}")]]
-        )
+        caption, keyboard = render_channel_post(product, reservation_store.reserved_sizes(product_id))
 
         # Отправляем пост в канал, определяя тип медиа
         file_id = product['file_id']
@@ -1119,12 +1097,14 @@ async def republish_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
         # Обновляем message_id в базе и уведомляем администратора
         print(f"Attempting to update message_id for product {product_id} in DB...")
-        update_message_id(product_id, sent_message.message_id)
+        await update_message_id(product_id, sent_message.message_id)
+        await save_post_render_hash(sent_message.message_id, product_id, render_hash(caption, keyboard))
 
         print("Attempting to send confirmation to admin...")
         await query.message.reply_text(f"Товар ID: {product_id} успішно опубліковано повторно.")
-        # Убираем кнопку "Опубликовать заново" из сообщения в каталоге
-        await query.edit_message_reply_markup(reply_markup=None)
+        # Убираем кнопку "Опубликовать заново" из карточки товара; сетку страницы каталога не трогаем
+        if query.message.text is None:
+            await query.edit_message_reply_markup(reply_markup=None)
         print("--- republish_callback finished successfully ---")
     except Exception as e:
         print(f"!!! КРИТИЧЕСКАЯ ОШИБКА в republish_callback: {e}")
@@ -1147,7 +1127,20 @@ async def edit_product_callback(update: Update, context: ContextTypes.DEFAULT_TY
         [InlineKeyboardButton("⬅️ Назад", callback_data=f"back_to_catalog_{product_id}")]
     ])
 
-    await query.edit_message_reply_markup(reply_markup=keyboard)
+    if query.message.text is None:
+        await query.edit_message_reply_markup(reply_markup=keyboard)
+        return
+
+    # Нажатие из сетки страницы каталога: редактирование идет в отдельной карточке товара
+    product = await get_product_by_id(product_id)
+    if not product:
+        await query.message.reply_text("Помилка: товар не знайдено.")
+        return
+    caption = f"Ціна: {product['price']} грн.\nРозміри в наявності: {product['sizes']}"
+    if product['file_id'].startswith("BAAC"):
+        await query.message.reply_video(video=product['file_id'], caption=caption, reply_markup=keyboard)
+    else:
+        await query.message.reply_photo(photo=product['file_id'], caption=caption, reply_markup=keyboard)
 
 
 async def back_to_catalog_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -1186,7 +1179,7 @@ async def edit_price_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -
 
 async def receive_new_price(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Получает новую цену, обновляет товар и исходное сообщение."""
-    add_message_to_history(user_id=update.effective_user.id, message_text=update.message.text, sender_type='user')
+    await add_message_to_history(user_id=update.effective_user.id, message_text=update.message.text, sender_type='user')
     new_price_text = update.message.text
     if not new_price_text.isdigit():
         await reply_and_log(update, "Будь ласка, введіть коректну ціну у вигляді числа.")
@@ -1201,33 +1194,12 @@ async def receive_new_price(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await reply_and_log(update, "Сталася помилка, спробуйте знову.")
         return ConversationHandler.END
 
-    update_product_price(product_id, new_price)
+    await update_product_price(product_id, new_price)
 
     # Обновляем пост в основном канале
-    product = get_product_by_id(product_id)
-    if product and product['message_id']:
-        try:
-            insole_lengths = json.loads(product['insole_lengths_json']) if product['insole_lengths_json'] else {}
-            sizes_list = [int(s) for s in product['sizes'].split(',') if s.isdigit()]
-            formatted_sizes = [f"<b>{s}</b> ({insole_lengths.get(str(s))} см)" if insole_lengths.get(str(s)) else f"<b>{s}</b>" for s in sorted(sizes_list)]
-            sizes_for_caption = ", ".join(formatted_sizes)
-            channel_caption = (f"Натуральна шкіра\n"
-                               f"{sizes_for_caption} розмір\n"
-                               f"{product['price']} грн наявність")
-            channel_keyboard = InlineKeyboardMarkup(
-                [[InlineKeyboardButton("🛒 Купити", url=f"https://t.me/{BOT_USERNAME}?start=buy_{product['id']}")]])
-
-            await context.bot.edit_message_caption(
-                chat_id=CHANNEL_ID,
-                message_id=product['message_id'],
-                caption=channel_caption,
-                reply_markup=channel_keyboard,
-                parse_mode='HTML'
-            )
-        except Exception as e:
-            print(f"Error updating channel post after price edit: {e}")
+    post_updater.notify(product_id)
 
-    product = get_product_by_id(product_id)
+    product = await get_product_by_id(product_id)
 
     new_caption = f"Ціна: {product['price']} грн.\nРозміри в наявності: {product['sizes']}"
     keyboard = InlineKeyboardMarkup([
@@ -1253,7 +1225,7 @@ async def edit_sizes_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     await query.answer()
 
     product_id = int(query.data.split('_')[2])
-    product = get_product_by_id(product_id)
+    product = await get_product_by_id(product_id)
 
     if not product:
         await query.edit_message_text("Помилка: товар не знайдено.")
@@ -1286,30 +1258,11 @@ async def edit_sizes_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
             return ConversationHandler.END
 
         new_sizes_str = ",".join(map(str, sorted(selected_sizes)))
-        update_product_sizes(product_id, new_sizes_str)
+        await update_product_sizes(product_id, new_sizes_str)
 
         # Обновляем пост в основном канале
-        product = get_product_by_id(product_id)
-        if product and product['message_id']:
-            try:
-                insole_lengths = json.loads(product['insole_lengths_json']) if product['insole_lengths_json'] else {}
-                formatted_sizes = [f"<b>{s}</b> ({insole_lengths.get(str(s))} см)" if insole_lengths.get(str(s)) else f"<b>{s}</b>" for s in sorted(selected_sizes)]
-                sizes_for_caption = ", ".join(formatted_sizes)
-                channel_caption = (f"Натуральна шкіра\n"
-                                   f"{sizes_for_caption} розмір\n"
-                                   f"{product['price']} грн наявність")
-                channel_keyboard = InlineKeyboardMarkup(
-                    [[InlineKeyboardButton("🛒 Купити", url=f"https://t.me/{BOT_USERNAME}?start=buy_{product['id']}")]])
-
-                await context.bot.edit_message_caption(
-                    chat_id=CHANNEL_ID,
-                    message_id=product['message_id'],
-                    caption=channel_caption,
-                    reply_markup=channel_keyboard,
-                    parse_mode='HTML'
-                )
-            except Exception as e:
-                print(f"Error updating channel post after size edit: {e}")
+        post_updater.notify(product_id)
+        product = await get_product_by_id(product_id)
 
         message_id = context.user_data.get('message_to_edit_id')
         chat_id = context.user_data.get('chat_id')
@@ -1352,46 +1305,21 @@ async def find_size_start(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     return AWAITING_SIZE_SEARCH
 
 
-async def display_search_page(update: Update, context: ContextTypes.DEFAULT_TYPE, size: int, page: int):
-    """Отображает страницу результатов поиска с галереей и клавиатурой."""
-    all_products = get_products_by_size(size)
-    all_products = [
-        p for p in all_products if p['sizes'].split(',').count(str(size)) > active_reservations.get(p['id'], []).count(str(size))
-    ]
-
-    chat_id = update.effective_chat.id
-
-    if not all_products and page == 1:
-        await context.bot.send_message(chat_id=chat_id, text="На жаль, за вашим запитом нічого не знайдено.")
-        return
-
-    page_size = 9
-    start_index = (page - 1) * page_size
-    end_index = page * page_size
-    products_on_page = all_products[start_index:end_index]
-
-    if not products_on_page:
-        query = update.callback_query
-        if query:
-            await query.answer("Більше товарів не знайдено.", show_alert=True)
-        return
-
-    # Отправка галереи
-    media_group = []
-    for i, product in enumerate(products_on_page):
-        caption = "Ось що ми знайшли:" if i == 0 and page == 1 else None
-        file_id = product['file_id']
-        if file_id.startswith("BAAC"):
-            media_group.append(InputMediaVideo(media=file_id, caption=caption))
-        else:
-            media_group.append(InputMediaPhoto(media=file_id, caption=caption))
+async def load_search_page(size: int, after_id: int = 0, before_id: int | None = None):
+    """
+    Возвращает страницу поиска по размеру: (кортеж (ID товара, file_id, подпись кнопки), есть ли
+    предыдущая страница, есть ли следующая страница). Страница кэшируется в search_cache, пока
+    не изменятся остатки или брони этого размера.
+    """
+    cursor = (after_id, before_id)
+    page, generation = search_cache.get(size, cursor)
+    if page is not None:
+        return page
 
-    if media_group:
-        await context.bot.send_media_group(chat_id=chat_id, media=media_group)
+    products, has_prev, has_next = await search_products_by_size(size, after_id, before_id)
 
-    # Отправка клавиатуры
-    keyboard_rows = []
-    for product in products_on_page:
+    entries = []
+    for product in products:
         length_text_part = ""
         if product['insole_lengths_json']:
             try:
@@ -1401,57 +1329,94 @@ async def display_search_page(update: Update, context: ContextTypes.DEFAULT_TYPE
                     length_text_part = f" ({length} см)"
             except (json.JSONDecodeError, TypeError):
                 pass
+        entries.append((product['id'], product['file_id'], f"{size}{length_text_part}-{product['price']}грн"))
+
+    page = (tuple(entries), has_prev, has_next)
+    search_cache.put(size, cursor, page, generation)
+    return page
 
-        button_text = f"{size}{length_text_part}-{product['price']}грн"
-        callback_data = f"gallery_select_{product['id']}_{size}"
-        keyboard_rows.append([InlineKeyboardButton(button_text, callback_data=callback_data)])
 
+async def display_search_page(update: Update, context: ContextTypes.DEFAULT_TYPE, size: int,
+                              after_id: int = 0, before_id: int | None = None) -> bool:
+    """
+    Отображает страницу результатов поиска с галереей и клавиатурой.
+    Страница выбирается по ID товара (после after_id или перед before_id); брони учитываются в запросе к БД.
+    Возвращает False, если на странице нет товаров.
+    """
+    entries, has_prev, has_next = await load_search_page(size, after_id, before_id)
+
+    chat_id = update.effective_chat.id
+
+    if not entries:
+        if not update.callback_query:
+            await context.bot.send_message(chat_id=chat_id, text="На жаль, за вашим запитом нічого не знайдено.")
+        return False
+
+    # Отправка галереи
+    captions = ["Ось що ми знайшли:" if i == 0 and not has_prev else None for i in range(len(entries))]
+    await send_product_media(context.bot, chat_id, [file_id for _, file_id, _ in entries], captions)
+
+    # Отправка клавиатуры
+    keyboard_rows = [
+        [InlineKeyboardButton(label, callback_data=f"gallery_select_{product_id}_{size}")]
+        for product_id, _, label in entries
+    ]
+
+    # Навигация по ключу: search_page_{a|b}_{ID товара}_{размер}
     nav_buttons = []
-    if start_index > 0:
-        nav_buttons.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"search_page_{page - 1}_{size}"))
-    if end_index < len(all_products):
-        nav_buttons.append(InlineKeyboardButton("Далі ➡️", callback_data=f"search_page_{page + 1}_{size}"))
+    if has_prev:
+        nav_buttons.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"search_page_b_{entries[0][0]}_{size}"))
+    if has_next:
+        nav_buttons.append(InlineKeyboardButton("Далі ➡️", callback_data=f"search_page_a_{entries[-1][0]}_{size}"))
 
     if nav_buttons:
         keyboard_rows.append(nav_buttons)
 
-    if keyboard_rows:
-        reply_markup = InlineKeyboardMarkup(keyboard_rows)
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text="Оберіть товар:",
-            reply_markup=reply_markup
-        )
+    reply_markup = InlineKeyboardMarkup(keyboard_rows)
+    await context.bot.send_message(
+        chat_id=chat_id,
+        text="Оберіть товар:",
+        reply_markup=reply_markup
+    )
+    return True
 
 
 async def size_search_received(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Начинает поиск по размеру и отображает первую страницу результатов."""
-    add_message_to_history(user_id=update.effective_user.id, message_text=update.message.text, sender_type='user')
+    await add_message_to_history(user_id=update.effective_user.id, message_text=update.message.text, sender_type='user')
     size_text = update.message.text
     if not size_text.isdigit():
         await reply_and_log(update, "Будь ласка, введіть розмір коректно у вигляді числа.")
         return AWAITING_SIZE_SEARCH
 
     size = int(size_text)
-    await display_search_page(update, context, size=size, page=1)
+    await display_search_page(update, context, size=size)
     return ConversationHandler.END
 
 
 async def search_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обрабатывает переключение страниц в результатах поиска."""
     query = update.callback_query
-    await query.answer()
 
     try:
-        _, _, page_str, size_str = query.data.split('_')
-        page = int(page_str)
+        _, _, direction, product_id_str, size_str = query.data.split('_')
+        product_id = int(product_id_str)
         size = int(size_str)
     except (ValueError, IndexError):
+        await query.answer()
         await query.message.reply_text("Помилка: некоректні дані для пагінації.")
         return
 
     # Отображаем новую страницу
-    await display_search_page(update, context, size=size, page=page)
+    if direction == 'a':
+        page_shown = await display_search_page(update, context, size=size, after_id=product_id)
+    else:
+        page_shown = await display_search_page(update, context, size=size, before_id=product_id)
+
+    if page_shown:
+        await query.answer()
+    else:
+        await query.answer("Більше товарів не знайдено.", show_alert=True)
 
 
 async def gallery_select_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -1466,7 +1431,7 @@ async def gallery_select_callback(update: Update, context: ContextTypes.DEFAULT_
         await query.message.reply_text("Помилка: Некоректний ID товару.")
         return
 
-    product = get_product_by_id(product_id)
+    product = await get_product_by_id(product_id)
     if not product or not product['sizes']:
         await query.message.reply_text("Вибачте, цей товар більше не доступний.")
         return
@@ -1491,27 +1456,9 @@ async def show_delete_list(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         await reply_and_log(update, "Ця команда доступна лише адміністратору.")
         return
 
-    products = get_all_products()
-
-    if not products:
-        await reply_and_log(update, "У каталозі немає товарів для видалення.")
-        return
-
     await reply_and_log(update, "Оберіть товар, який хочете видалити:")
-    for product in products:
-        caption = f"ID: {product['id']}\nЦіна: {product['price']} грн.\nРозміри: {product['sizes']}"
-        keyboard = InlineKeyboardMarkup(
-            [[InlineKeyboardButton("❌ Видалити цей товар", callback_data=f"del_{product['id']}")]]
-        )
-
-        if product['file_id'].startswith("BAAC"):
-            await update.message.reply_video(
-                video=product['file_id'], caption=caption, reply_markup=keyboard
-            )
-        else:
-            await update.message.reply_photo(
-                photo=product['file_id'], caption=caption, reply_markup=keyboard
-            )
+    if not await send_catalog_page(context.bot, update.effective_chat.id, DELETE_MODE, is_admin=True):
+        await reply_and_log(update, "У каталозі немає товарів для видалення.")
 
 
 async def delete_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -1527,7 +1474,9 @@ async def delete_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             InlineKeyboardButton("❌ Ні, скасувати", callback_data="cancel_del")
         ]
     ])
-    await query.edit_message_reply_markup(reply_markup=None)
+    # Кнопки карточки товара убираем; сетку страницы каталога оставляем для других товаров
+    if query.message.text is None:
+        await query.edit_message_reply_markup(reply_markup=None)
     await query.message.reply_text(
         f"Ви впевнені, що хочете видалити товар ID: {product_id}?",
         reply_markup=keyboard
@@ -1540,7 +1489,7 @@ async def confirm_delete_callback(update: Update, context: ContextTypes.DEFAULT_
     await query.answer()
 
     product_id = int(query.data.split('_')[2])
-    product = get_product_by_id(product_id)
+    product = await get_product_by_id(product_id)
 
     if product and product['message_id']:
         try:
@@ -1548,7 +1497,7 @@ async def confirm_delete_callback(update: Update, context: ContextTypes.DEFAULT_
         except Exception as e:
             print(f"Не удалось удалить сообщение {product['message_id']} из канала: {e}")
 
-    delete_product_by_id(product_id)
+    await delete_product_by_id(product_id)
     await query.edit_message_text("Товар успішно видалено.")
 
 
@@ -1592,6 +1541,19 @@ async def receive_details(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     return ConversationHandler.END
 
 
+async def release_abandoned_reservation(user_id: int, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Снимает брони корзины, если клиент вышел из оформления заказа до отправки его менеджеру.
+    Сроки в очереди истечения не трогаем: для уже снятых броней проверка просто ничего не найдет.
+    """
+    items = context.user_data.pop('cart_items_for_confirmation', None)
+    if not items:
+        return
+    released = await reservation_store.release(user_id, items)
+    for product_id in {item['product_id'] for item in released}:
+        post_updater.notify(product_id)
+
+
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Отменяет текущий диалог, корректно обрабатывая команду и таймаут."""
     cancel_message = "Дію скасовано."
@@ -1610,9 +1572,10 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     elif user_id:
         await context.bot.send_message(chat_id=user_id, text=cancel_message)
 
-    # Логируем, если удалось определить пользователя
+    # Логируем, если удалось определить пользователя, и снимаем брони брошенной корзины
     if user_id:
-        add_message_to_history(user_id=user_id, message_text=cancel_message, sender_type='bot')
+        await release_abandoned_reservation(user_id, context)
+        await add_message_to_history(user_id=user_id, message_text=cancel_message, sender_type='bot')
 
     return ConversationHandler.END
 
@@ -1622,8 +1585,9 @@ async def handle_timeout(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     user_id = context._user_id
     cancel_message = "Дію скасовано через час очікування."
     if user_id:
+        await release_abandoned_reservation(user_id, context)
         await context.bot.send_message(chat_id=user_id, text=cancel_message)
-        add_message_to_history(user_id=user_id, message_text=cancel_message, sender_type='bot')
+        await add_message_to_history(user_id=user_id, message_text=cancel_message, sender_type='bot')
     return ConversationHandler.END
 
 
@@ -1695,7 +1659,7 @@ async def add_faq_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
 
 async def get_keywords(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Сохраняет ключевые слова и запрашивает ответ."""
-    add_message_to_history(user_id=update.effective_user.id, message_text=update.message.text, sender_type='user')
+    await add_message_to_history(user_id=update.effective_user.id, message_text=update.message.text, sender_type='user')
     context.user_data['faq_keywords'] = update.message.text
     await reply_and_log(update, "Отлично. Теперь введите полный текст ответа на этот вопрос.")
     return GETTING_ANSWER
@@ -1703,11 +1667,11 @@ async def get_keywords(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
 
 async def get_answer(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Сохраняет ответ, добавляет запись в БД и завершает диалог."""
-    add_message_to_history(user_id=update.effective_user.id, message_text=update.message.text, sender_type='user')
+    await add_message_to_history(user_id=update.effective_user.id, message_text=update.message.text, sender_type='user')
     keywords = context.user_data.get('faq_keywords')
     answer = update.message.text
 
-    add_faq(keywords=keywords, answer=answer)
+    await add_faq(keywords=keywords, answer=answer)
 
     await reply_and_log(update, "✅ Новая запись в базу знаний успешно добавлена.")
 
@@ -1721,7 +1685,7 @@ async def list_faq(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await reply_and_log(update, "Ця команда доступна лише адміністратору.")
         return
 
-    all_faq_entries = get_all_faq()
+    all_faq_entries = await get_all_faq()
 
     if not all_faq_entries:
         await reply_and_log(update, "База знаний пуста.")
@@ -1746,12 +1710,31 @@ async def delete_faq_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
 
     try:
         faq_id = int(query.data.split('_')[2])
-        delete_faq_by_id(faq_id)
+        await delete_faq_by_id(faq_id)
         await query.edit_message_text(text="✅ Запись успешно удалена.", reply_markup=None)
     except (IndexError, ValueError):
         await query.edit_message_text("Ошибка: неверный ID для удаления.")
 
 
+async def fan_out_to_admins(metric_name: str, sends: dict) -> dict:
+    """
+    Одновременно выполняет отправки администраторам ({admin_id: корутина}) и замеряет общую длительность.
+    Ошибка отправки одному администратору не мешает остальным.
+    Возвращает {admin_id: результат} для успешных отправок.
+    """
+    started = time.monotonic()
+    results = await asyncio.gather(*sends.values(), return_exceptions=True)
+    metrics.observe(metric_name, time.monotonic() - started)
+
+    delivered = {}
+    for admin_id, result in zip(sends, results):
+        if isinstance(result, Exception):
+            logging.warning(f"Не удалось отправить уведомление админу {admin_id}: {result}")
+        else:
+            delivered[admin_id] = result
+    return delivered
+
+
 async def accept_chat_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обрабатывает нажатие на кнопку 'Взять в работу'."""
     query = update.callback_query
@@ -1765,34 +1748,35 @@ async def accept_chat_callback(update: Update, context: ContextTypes.DEFAULT_TYP
         await query.edit_message_text("Ошибка: неверный ID пользователя в callback_data.")
         return
 
-    chat_session = get_chat_by_user_id(user_id)
-
-    if chat_session and chat_session['status'] == 'waiting':
-        set_chat_status(user_id=user_id, status='in_progress', admin_id=admin_id)
-
+    # Условный UPDATE: из нескольких администраторов, нажавших кнопку одновременно, чат получит только один
+    if await claim_waiting_chat(user_id, admin_id):
         notification_messages = context.bot_data.pop(f"chat_notifications_{user_id}", None)
 
-        if notification_messages:
-            for notif_admin_id, notif_message_id in notification_messages:
-                try:
-                    if notif_admin_id == query.from_user.id:
-                        new_text_for_admin = (
-                            f"✅ Вы приняли диалог с пользователем {user_info.full_name} в работу.\n\n"
-                            "Теперь все ваши сообщения боту (без команд) будут пересылаться ему.\n\n"
-                            f"Для завершения диалога используйте команду /endchat {user_id}"
-                        )
-                        await context.bot.edit_message_text(text=new_text_for_admin, chat_id=notif_admin_id, message_id=notif_message_id, reply_markup=None)
-                    else:
-                        text_for_other_admins = f"⚠️ Диалог с пользователем {user_info.full_name} был принят в работу другим администратором."
-                        await context.bot.edit_message_text(text=text_for_other_admins, chat_id=notif_admin_id, message_id=notif_message_id, reply_markup=None)
-                except error.BadRequest as e:
-                    if "Message is not modified" in str(e):
-                        logging.info(f"Message {notif_message_id} for admin {notif_admin_id} was already modified.")
-                    else:
-                        logging.warning(f"Could not edit notification for admin {notif_admin_id}: {e}")
-                except Exception as e:
+        async def update_notification(notif_admin_id, notif_message_id):
+            try:
+                if notif_admin_id == query.from_user.id:
+                    new_text_for_admin = (
+                        f"✅ Вы приняли диалог с пользователем {user_info.full_name} в работу.\n\n"
+                        "Теперь все ваши сообщения боту (без команд) будут пересылаться ему.\n\n"
+                        f"Для завершения диалога используйте команду /endchat {user_id}"
+                    )
+                    await context.bot.edit_message_text(text=new_text_for_admin, chat_id=notif_admin_id, message_id=notif_message_id, reply_markup=None)
+                else:
+                    text_for_other_admins = f"⚠️ Диалог с пользователем {user_info.full_name} был принят в работу другим администратором."
+                    await context.bot.edit_message_text(text=text_for_other_admins, chat_id=notif_admin_id, message_id=notif_message_id, reply_markup=None)
+            except error.BadRequest as e:
+                if "Message is not modified" in str(e):
+                    logging.info(f"Message {notif_message_id} for admin {notif_admin_id} was already modified.")
+                else:
                     logging.warning(f"Could not edit notification for admin {notif_admin_id}: {e}")
 
+        if notification_messages:
+            # Уведомления всех администраторов редактируются одновременно
+            await fan_out_to_admins('admin_fanout.accept_chat', {
+                notif_admin_id: update_notification(notif_admin_id, notif_message_id)
+                for notif_admin_id, notif_message_id in notification_messages
+            })
+
         await context.bot.send_message(
             chat_id=user_id, text="До вашого діалогу підключився менеджер. Будь ласка, очікуйте на відповідь."
         )
@@ -1816,7 +1800,7 @@ async def clear_chat_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await reply_and_log(update, "ID пользователя должен быть числом.")
         return
 
-    delete_chat(user_id=user_id)
+    await delete_chat(user_id=user_id)
     await reply_and_log(update, f"✅ Сессия чата для пользователя с ID {user_id} была успешно удалена.")
 
 
@@ -1836,7 +1820,7 @@ async def get_history_command(update: Update, context: ContextTypes.DEFAULT_TYPE
         await reply_and_log(update, "ID пользователя должен быть числом.")
         return
 
-    history_records = get_history_for_user(user_id=user_id)
+    history_records = await get_history_for_user(user_id=user_id)
 
     if not history_records:
         await reply_and_log(update, f"История сообщений для пользователя {user_id} пуста.")
@@ -1851,6 +1835,23 @@ async def get_history_command(update: Update, context: ContextTypes.DEFAULT_TYPE
     await reply_and_log(update, response_text, parse_mode='HTML')
 
 
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Показывает администратору внутренние счетчики бота (кэш товаров и т.п.)."""
+    if update.effective_user.id not in ADMIN_IDS:
+        await reply_and_log(update, "Ця команда доступна лише адміністратору.")
+        return
+
+    cache_stats = product_cache.stats()
+    search_stats = search_cache.stats()
+    lines = [
+        f"Кеш товарів: {cache_stats['hits']} влучань, {cache_stats['misses']} промахів, {cache_stats['size']} записів",
+        f"Кеш пошуку: {search_stats['hits']} влучань, {search_stats['misses']} промахів, {search_stats['size']} сторінок",
+    ]
+    lines.extend(f"{name}: {value}" for name, value in sorted(metrics.snapshot().items())
+                 if not name.startswith(('product_cache.', 'search_cache.')))
+    await reply_and_log(update, "\n".join(lines))
+
+
 async def end_chat_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Завершает активный живой чат с пользователем."""
     admin_id = update.effective_user.id
@@ -1858,16 +1859,16 @@ async def end_chat_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await reply_and_log(update, "Ця команда доступна лише адміністратору.")
         return
 
-    active_chat = get_chat_by_admin_id(admin_id)
+    active_chat = await get_chat_by_admin_id(admin_id)
 
     if active_chat:
         user_id = active_chat['user_id']
-        delete_chat(user_id=user_id)
+        await delete_chat(user_id=user_id)
         await reply_and_log(update, f"✅ Вы успешно завершили диалог с пользователем {user_id}.")
 
         client_message = "Менеджер завершив діалог. Якщо у вас є нові питання, просто напишіть їх у цей чат."
         await context.bot.send_message(chat_id=user_id, text=client_message)
-        add_message_to_history(user_id, "Менеджер завершив діалог...", 'bot')
+        await add_message_to_history(user_id, "Менеджер завершив діалог...", 'bot')
     else:
         await reply_and_log(update, "У вас нет активных диалогов для завершения.")
 
@@ -1881,22 +1882,22 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Проверяем, не является ли отправитель админом в активном чате
     admin_id = update.effective_user.id
     if admin_id in ADMIN_IDS:
-        active_chat = get_chat_by_admin_id(admin_id)
+        active_chat = await get_chat_by_admin_id(admin_id)
         if active_chat:
             user_id = active_chat['user_id']
             message_text = update.message.text
             await context.bot.send_message(chat_id=user_id, text=message_text)
-            add_message_to_history(user_id=user_id, message_text=message_text, sender_type='bot')
+            await add_message_to_history(user_id=user_id, message_text=message_text, sender_type='bot')
             return
 
-    add_message_to_history(user_id=update.effective_user.id, message_text=update.message.text, sender_type='user')
+    await add_message_to_history(user_id=update.effective_user.id, message_text=update.message.text, sender_type='user')
     user_message = update.message.text
-    answer = find_faq_by_keywords(user_message)
+    answer = await find_faq_by_keywords(user_message)
     if answer:
         await reply_and_log(update, answer)
     else:
         user = update.effective_user
-        chat_session = get_chat_by_user_id(user.id)
+        chat_session = await get_chat_by_user_id(user.id)
 
         if chat_session:
             if chat_session['status'] == 'in_progress':
@@ -1905,11 +1906,9 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await context.bot.send_message(chat_id=admin_id, text=text_to_forward)
         else:
             # Если сессии нет, создаем новую и уведомляем админов
-            set_chat_status(user_id=user.id, status='waiting')
-
-            notification_messages = []
+            await set_chat_status(user_id=user.id, status='waiting')
 
-            history_records = get_history_for_user(user.id, limit=5)
+            history_records = await get_history_for_user(user.id, limit=5)
             if history_records:
                 formatted_lines = []
                 for record in reversed(history_records):
@@ -1930,21 +1929,71 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 [InlineKeyboardButton("Взять в работу", callback_data=f"accept_chat_{user.id}")]
             ])
 
-            for admin_id in ADMIN_IDS:
-                try:
-                    sent_message = await context.bot.send_message(chat_id=admin_id, text=text_for_admin, reply_markup=keyboard, parse_mode='HTML')
-                    notification_messages.append((admin_id, sent_message.message_id))
-                except Exception as e:
-                    logging.warning(f"Не удалось отправить уведомление админу {admin_id}: {e}")
-            
+            # Уведомления всем администраторам отправляются одновременно
+            sent_messages = await fan_out_to_admins('admin_fanout.new_chat', {
+                admin_id: context.bot.send_message(chat_id=admin_id, text=text_for_admin, reply_markup=keyboard, parse_mode='HTML')
+                for admin_id in ADMIN_IDS
+            })
+            notification_messages = [(admin_id, sent_message.message_id) for admin_id, sent_message in sent_messages.items()]
+
             if notification_messages:
                 context.bot_data[f"chat_notifications_{user.id}"] = notification_messages
 
 
+async def flush_history_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Периодически записывает буфер истории переписки в БД, даже если новых сообщений нет."""
+    await flush_message_history()
+
+
+async def restore_reservations(application: Application) -> None:
+    """
+    Загружает брони из БД после перезапуска: возвращает их сроки в очередь истечения (просроченные
+    брони снимутся при ближайшей проверке) и перерисовывает посты товаров с бронями.
+    """
+    reservations = await reservation_store.load()
+    # Брони без срока остались от версии, где оплаченные брони ждали подтверждения бессрочно.
+    # Заказы в bot_data после перезапуска потеряны, поэтому такие брони получают обычный срок оплаченной брони
+    paid_expires_at = datetime.now(timezone.utc) + timedelta(seconds=PAID_HOLD_DURATION)
+    for user_id in {reservation['user_id'] for reservation in reservations if reservation['expires_at'] is None}:
+        await reservation_store.extend(user_id, paid_expires_at)
+        expiry_queue.schedule(user_id, paid_expires_at)
+    for reservation in reservations:
+        post_updater.notify(reservation['product_id'])
+        if reservation['expires_at'] is not None:
+            expiry_queue.schedule(reservation['user_id'], reservation['expires_at'])
+    print(f"Восстановлено броней: {len(reservations)}, сроков в очереди: {len(expiry_queue)}")
+
+
+async def on_startup(application: Application) -> None:
+    """Запускает фоновое обновление постов в канале и восстанавливает брони после перезапуска."""
+    post_updater.start(application.bot)
+    await restore_reservations(application)
+
+
+async def on_stop(application: Application) -> None:
+    """
+    Отправляет отложенные правки постов в канале. Вызывается из post_stop, пока бот еще может
+    делать запросы: к post_shutdown HTTP-клиент бота уже закрыт.
+    """
+    await post_updater.stop()
+
+
+async def on_shutdown(application: Application) -> None:
+    """Завершает запросы к базе данных и закрывает постоянные соединения при остановке бота."""
+    await flush_message_history()
+    shutdown_db_executor()
+    close_db_connections()
+
+
 def main() -> None:
     """Основная функция для запуска бота."""
     init_db()
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    application = (Application.builder().token(TELEGRAM_BOT_TOKEN)
+                   .rate_limiter(OutboundRateLimiter())
+                   .concurrent_updates(KeyedUpdateProcessor())
+                   .post_init(on_startup).post_stop(on_stop).post_shutdown(on_shutdown).build())
+    application.job_queue.run_repeating(flush_history_job, interval=HISTORY_FLUSH_INTERVAL)
+    application.job_queue.run_repeating(expire_reservations_job, interval=SWEEP_INTERVAL)
 
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler('addproduct', add_product_start)],
@@ -2049,6 +2098,7 @@ def main() -> None:
     application.add_handler(CommandHandler('clear_chat', clear_chat_command))
     application.add_handler(CommandHandler('endchat', end_chat_command))
     application.add_handler(CommandHandler('get_history', get_history_command))
+    application.add_handler(CommandHandler('stats', stats_command))
     application.add_handler(CallbackQueryHandler(delete_faq_callback, pattern='^faq_delete_'))
     application.add_handler(CallbackQueryHandler(accept_chat_callback, pattern='^accept_chat_'))
     application.add_handler(CommandHandler("testbutton", test_button))
@@ -2060,6 +2110,7 @@ def main() -> None:
     application.add_handler(CallbackQueryHandler(republish_callback, pattern='^repub_'))
     application.add_handler(CallbackQueryHandler(edit_product_callback, pattern='^edit_'))
     application.add_handler(CallbackQueryHandler(back_to_catalog_callback, pattern='^back_to_catalog_'))
+    application.add_handler(CallbackQueryHandler(catalog_page_callback, pattern='^catalog_page_'))
     application.add_handler(CallbackQueryHandler(size_callback, pattern='^ps_'))
     application.add_handler(CallbackQueryHandler(checkout_callback, pattern='^checkout$'))
     application.add_handler(CallbackQueryHandler(remove_item_callback, pattern='^remove_item_'))
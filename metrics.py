@@ -0,0 +1,35 @@
+import threading
+
+_counters = {}
+_timings = {}
+_lock = threading.Lock()
+
+
+def increment(name: str, amount: int = 1):
+    """
+    Увеличивает счетчик name на amount.
+    """
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+def observe(name: str, value: float):
+    """
+    Учитывает одно измерение (например, длительность в секундах) для метрики name.
+    """
+    with _lock:
+        count, total, maximum = _timings.get(name, (0, 0.0, 0.0))
+        _timings[name] = (count + 1, total + value, max(maximum, value))
+
+
+def snapshot() -> dict:
+    """
+    Возвращает текущие значения всех счетчиков и сводку по измерениям (count/avg/max).
+    """
+    with _lock:
+        result = dict(_counters)
+        for name, (count, total, maximum) in _timings.items():
+            result[f"{name}.count"] = count
+            result[f"{name}.avg"] = round(total / count, 4) if count else 0.0
+            result[f"{name}.max"] = round(maximum, 4)
+    return result
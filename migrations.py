@@ -0,0 +1,226 @@
+import logging
+from collections import Counter
+
+from db_connection import read_connection, write_transaction
+
+logger = logging.getLogger(__name__)
+
+BACKFILL_BATCH_SIZE = 500
+
+
+def _create_base_tables(cursor):
+    """
+    Версия 1: исходные таблицы бота.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS products (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            file_id TEXT NOT NULL,
+            price INTEGER NOT NULL,
+            sizes TEXT NOT NULL,
+            is_sold INTEGER DEFAULT 0,
+            message_id INTEGER
+        )
+    ''')
+
+    # В старых базах колонки insole_lengths_json может не быть
+    cursor.execute("PRAGMA table_info(products)")
+    columns = [column[1] for column in cursor.fetchall()]
+    if 'insole_lengths_json' not in columns:
+        cursor.execute("ALTER TABLE products ADD COLUMN insole_lengths_json TEXT")
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS faq (
+            id INTEGER PRIMARY KEY,
+            keywords TEXT NOT NULL,
+            answer TEXT NOT NULL
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS live_chats (
+            user_id INTEGER PRIMARY KEY,
+            admin_id INTEGER,
+            status TEXT NOT NULL,
+            last_update TIMESTAMP
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS message_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            message_text TEXT NOT NULL,
+            sender_type TEXT NOT NULL,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS customers (
+            user_id INTEGER PRIMARY KEY,
+            full_name TEXT,
+            phone_number TEXT
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS orders (
+            order_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            customer_user_id INTEGER,
+            delivery_address TEXT,
+            ttn TEXT,
+            status TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS order_items (
+            item_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER,
+            product_id INTEGER,
+            size TEXT,
+            price_at_purchase INTEGER
+        )
+    ''')
+
+
+def _create_product_sizes(cursor):
+    """
+    Версия 2: остатки по размерам в отдельной таблице.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS product_sizes (
+            product_id INTEGER NOT NULL,
+            size TEXT NOT NULL,
+            quantity INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (product_id, size)
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_product_sizes_size ON product_sizes (size, product_id)")
+
+
+def _backfill_product_sizes(cursor, after_id: int, batch_size: int) -> int | None:
+    """
+    Переносит размеры из строки products.sizes в product_sizes для очередной пачки товаров.
+    Возвращает ID последнего обработанного товара или None, если товаров больше нет.
+    """
+    cursor.execute("""
+        SELECT id, sizes FROM products
+        WHERE id > ? AND NOT EXISTS (SELECT 1 FROM product_sizes WHERE product_id = products.id)
+        ORDER BY id LIMIT ?
+    """, (after_id, batch_size))
+    products = cursor.fetchall()
+    if not products:
+        return None
+
+    rows = []
+    for product_id, sizes in products:
+        counts = Counter(size.strip() for size in sizes.split(',') if size.strip())
+        rows.extend((product_id, size, quantity) for size, quantity in counts.items())
+    cursor.executemany("INSERT INTO product_sizes (product_id, size, quantity) VALUES (?, ?, ?)", rows)
+    return products[-1][0]
+
+
+def _create_indexes(cursor):
+    """
+    Версия 3: индексы для часто выполняемых запросов.
+    """
+    # Частичный индекс: в каталоге и поиске участвуют только непроданные товары
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_products_unsold ON products (id) WHERE is_sold = 0")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_message_history_user_time ON message_history (user_id, timestamp)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_orders_customer_created ON orders (customer_user_id, created_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_order_items_order ON order_items (order_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_live_chats_admin_status ON live_chats (admin_id, status)")
+
+
+def _create_channel_posts(cursor):
+    """
+    Версия 4: хэш последней опубликованной подписи и клавиатуры для каждого поста в канале.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS channel_posts (
+            message_id INTEGER PRIMARY KEY,
+            product_id INTEGER NOT NULL,
+            render_hash TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+def _create_reservations(cursor):
+    """
+    Версия 5: брони размеров с временем истечения (UTC).
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS reservations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            product_id INTEGER NOT NULL,
+            size TEXT NOT NULL,
+            expires_at TIMESTAMP,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_reservations_product_size ON reservations (product_id, size)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_reservations_user ON reservations (user_id)")
+
+
+def _create_reservation_expiry_index(cursor):
+    """
+    Версия 6: индекс для пакетного снятия истекших броней.
+    """
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_reservations_expires ON reservations (expires_at)")
+
+
+# Упорядоченный список миграций: (версия, описание, изменение схемы, перенос данных или None).
+# Новые миграции добавляются только в конец списка со следующим номером версии.
+MIGRATIONS = [
+    (1, "базовые таблицы", _create_base_tables, None),
+    (2, "остатки по размерам в product_sizes", _create_product_sizes, _backfill_product_sizes),
+    (3, "индексы для частых запросов", _create_indexes, None),
+    (4, "хэши опубликованных постов", _create_channel_posts, None),
+    (5, "брони размеров", _create_reservations, None),
+    (6, "индекс сроков броней", _create_reservation_expiry_index, None),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def get_schema_version() -> int:
+    """
+    Возвращает текущую версию схемы из PRAGMA user_version.
+    """
+    with read_connection() as conn:
+        return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(batch_size: int = BACKFILL_BATCH_SIZE):
+    """
+    Применяет по порядку все миграции новее текущей версии схемы.
+    Если схема актуальна, ничего не делает.
+    Перенос данных выполняется пачками по batch_size строк, каждая в своей транзакции,
+    а версия схемы повышается только после его завершения.
+    """
+    current_version = get_schema_version()
+    if current_version >= LATEST_VERSION:
+        return
+
+    for version, description, apply_schema, backfill in MIGRATIONS:
+        if version <= current_version:
+            continue
+        logger.info("Применяю миграцию %s: %s", version, description)
+
+        with write_transaction() as cursor:
+            apply_schema(cursor)
+            if backfill is None:
+                cursor.execute(f"PRAGMA user_version = {version}")
+
+        if backfill is not None:
+            last_id = 0
+            while last_id is not None:
+                with write_transaction() as cursor:
+                    last_id = backfill(cursor, last_id, batch_size)
+            with write_transaction() as cursor:
+                cursor.execute(f"PRAGMA user_version = {version}")
@@ -0,0 +1,60 @@
+import hashlib
+import json
+from collections import Counter
+from functools import lru_cache
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from config import BOT_USERNAME
+from inventory import size_sort_key
+
+RENDER_CACHE_SIZE = 1024
+
+
+@lru_cache(maxsize=RENDER_CACHE_SIZE)
+def _render(product_id: int, price: int, sizes: str, insole_lengths_json: str | None, reserved: tuple):
+    """
+    Строит подпись и клавиатуру поста. Кэшируется по содержимому товара и набору броней.
+    """
+    available = Counter(size for size in sizes.split(',') if size) if sizes else Counter()
+    available.subtract(Counter(reserved))
+    available_sizes = sorted((+available).elements(), key=size_sort_key)
+
+    if not available_sizes:
+        return f"Натуральна шкіра\nПРОДАНО\n{price} грн наявність", None
+
+    insole_lengths = json.loads(insole_lengths_json) if insole_lengths_json else {}
+    formatted_sizes = []
+    for size in available_sizes:
+        length = insole_lengths.get(size)
+        if length is not None:
+            formatted_sizes.append(f"<b>{size}</b> ({length} см)")
+        else:
+            formatted_sizes.append(f"<b>{size}</b>")
+    caption = (f"Натуральна шкіра\n"
+               f"{', '.join(formatted_sizes)} розмір\n"
+               f"{price} грн наявність")
+    keyboard = InlineKeyboardMarkup(
+        [[InlineKeyboardButton("🛒 Купити", url=f"https://t.me/{BOT_USERNAME}?start=buy_{product_id}")]]
+    )
+    return caption, keyboard
+
+
+def render_hash(caption: str, keyboard: InlineKeyboardMarkup | None) -> str:
+    """
+    Возвращает хэш отрисованного поста: по нему видно, изменится ли пост после редактирования.
+    """
+    markup = json.dumps(keyboard.to_dict(), sort_keys=True, ensure_ascii=False) if keyboard else ''
+    return hashlib.sha256(f"{caption}\n{markup}".encode('utf-8')).hexdigest()
+
+
+def render_channel_post(product, reserved_sizes=()) -> tuple[str, InlineKeyboardMarkup | None]:
+    """
+    Возвращает (подпись в HTML, клавиатура) для поста товара в канале.
+    Забронированные размеры не показываются; если свободных размеров нет,
+    пост помечается как проданный и клавиатура не нужна (None).
+    """
+    return _render(
+        product['id'], product['price'], product['sizes'], product['insole_lengths_json'],
+        tuple(sorted(str(size) for size in reserved_sizes))
+    )
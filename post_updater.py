@@ -0,0 +1,66 @@
+import asyncio
+import logging
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+DEBOUNCE_SECONDS = 1.0
+
+
+class PostUpdater:
+    """
+    Фоновая задача, которая объединяет всплески изменений товара в одно редактирование поста.
+    Обработчики сообщают «товар изменился» через notify(); после паузы DEBOUNCE_SECONDS
+    все накопленные товары перерисовываются один раз по своему последнему состоянию.
+    """
+
+    def __init__(self, refresh, debounce_seconds: float = DEBOUNCE_SECONDS):
+        """
+        refresh — корутина refresh(bot, product_ids), которая перерисовывает посты товаров.
+        """
+        self._refresh = refresh
+        self._debounce_seconds = debounce_seconds
+        self._pending = set()
+        self._wakeup = asyncio.Event()
+        self._bot = None
+        self._task = None
+
+    def notify(self, product_id: int):
+        """Отмечает, что пост товара нужно перерисовать."""
+        metrics.increment('post_updater.notifications')
+        self._pending.add(product_id)
+        self._wakeup.set()
+
+    def start(self, bot):
+        """Запускает фоновую задачу обновления постов."""
+        self._bot = bot
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Останавливает задачу и сразу применяет изменения, которые еще ждут паузы."""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self._flush()
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            await asyncio.sleep(self._debounce_seconds)
+            await self._flush()
+
+    async def _flush(self):
+        self._wakeup.clear()
+        if not self._pending:
+            return
+        product_ids, self._pending = self._pending, set()
+        metrics.increment('post_updater.refreshed_products', len(product_ids))
+        try:
+            await self._refresh(self._bot, product_ids)
+        except Exception as e:
+            logger.warning("Не удалось обновить посты товаров %s: %s", sorted(product_ids), e)
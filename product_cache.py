@@ -0,0 +1,78 @@
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+
+PRODUCT_CACHE_SIZE = 512
+PRODUCT_CACHE_TTL = 300  # секунд
+
+_entries = OrderedDict()  # product_id -> (время сохранения, товар)
+_generation = 0
+_lock = threading.Lock()
+
+
+def get(product_id: int):
+    """
+    Возвращает пару (товар или None, поколение кэша).
+    Поколение нужно передать в put, чтобы не сохранить устаревшую строку,
+    если товар был изменен, пока шел запрос к БД.
+    """
+    with _lock:
+        entry = _entries.get(product_id)
+        if entry is not None:
+            stored_at, product = entry
+            if time.monotonic() - stored_at < PRODUCT_CACHE_TTL:
+                _entries.move_to_end(product_id)
+                metrics.increment('product_cache.hits')
+                return product, _generation
+            del _entries[product_id]
+        metrics.increment('product_cache.misses')
+        return None, _generation
+
+
+def put(product_id: int, product, generation: int):
+    """
+    Сохраняет товар в кэш, если с момента промаха не было инвалидаций.
+    """
+    with _lock:
+        if generation != _generation:
+            return
+        _entries[product_id] = (time.monotonic(), product)
+        _entries.move_to_end(product_id)
+        while len(_entries) > PRODUCT_CACHE_SIZE:
+            _entries.popitem(last=False)
+
+
+def invalidate(product_id: int):
+    """
+    Удаляет товар из кэша после изменения его строки в БД.
+    """
+    global _generation
+    with _lock:
+        _generation += 1
+        _entries.pop(product_id, None)
+
+
+def clear():
+    """
+    Полностью очищает кэш.
+    """
+    global _generation
+    with _lock:
+        _generation += 1
+        _entries.clear()
+
+
+def stats() -> dict:
+    """
+    Возвращает число попаданий, промахов и текущий размер кэша.
+    """
+    counters = metrics.snapshot()
+    with _lock:
+        size = len(_entries)
+    return {
+        'hits': counters.get('product_cache.hits', 0),
+        'misses': counters.get('product_cache.misses', 0),
+        'size': size,
+    }
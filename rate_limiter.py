@@ -0,0 +1,176 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты исходящих запросов: меньшее значение отправляется раньше
+PRIORITY_USER = 0
+PRIORITY_BULK = 1
+
+# Лимиты Bot API: ~30 запросов в секунду всего, ~1 сообщение в секунду в один личный чат,
+# ~20 сообщений в минуту в одну группу или канал
+GLOBAL_RATE = 30
+GLOBAL_BURST = 30
+PRIVATE_CHAT_RATE = 1
+PRIVATE_CHAT_BURST = 3
+GROUP_CHAT_RATE = 20 / 60
+GROUP_CHAT_BURST = 3
+MAX_RETRIES = 3
+# Методы, на которые действуют лимиты отдельного чата: отправка и правка сообщений.
+# Остальные запросы с chat_id (getChat, answerCallbackQuery и т.п.) проходят только общий лимит
+CHAT_LIMITED_METHODS = ('send', 'edit', 'copy', 'forward')
+# Через сколько секунд простоя корзина чата удаляется
+IDLE_BUCKET_SECONDS = 300
+
+
+class TokenBucket:
+    """
+    Корзина токенов: rate токенов в секунду, не больше burst накопленных.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self) -> float:
+        """Возвращает, сколько секунд ждать до появления токена (0, если токен есть)."""
+        self._refill()
+        return 0.0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+
+    def consume(self):
+        self._tokens -= 1
+
+    def idle_since(self) -> float:
+        return self._updated
+
+    async def acquire(self):
+        """Дожидается токена и забирает его; ожидающие обслуживаются по очереди."""
+        async with self.lock:
+            delay = self.delay()
+            while delay > 0:
+                await asyncio.sleep(delay)
+                delay = self.delay()
+            self.consume()
+
+
+class OutboundRateLimiter(BaseRateLimiter[int]):
+    """
+    Планировщик исходящих запросов бота: корзины токенов на общий лимит Bot API,
+    на каждый личный чат и на каждую группу или канал.
+    Ответы пользователям в личных чатах проходят общий лимит раньше массовых отправок в каналы;
+    приоритет можно задать явно через rate_limit_args (PRIORITY_USER или PRIORITY_BULK).
+    При RetryAfter все отправки приостанавливаются на указанное время, и запрос повторяется.
+    """
+
+    def __init__(self, max_retries: int = MAX_RETRIES):
+        self._max_retries = max_retries
+        self._global = TokenBucket(GLOBAL_RATE, GLOBAL_BURST)
+        self._chat_buckets = {}
+        self._waiting = []
+        self._sequence = itertools.count()
+        self._condition = None
+        self._paused_until = 0.0
+
+    async def initialize(self) -> None:
+        self._condition = asyncio.Condition()
+
+    async def shutdown(self) -> None:
+        self._chat_buckets.clear()
+
+    @staticmethod
+    def _is_private_chat(chat_id) -> bool:
+        """У личных чатов положительный ID; группы и каналы — отрицательные ID или @username."""
+        return isinstance(chat_id, int) and chat_id > 0
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            self._drop_idle_buckets()
+            if self._is_private_chat(chat_id):
+                bucket = TokenBucket(PRIVATE_CHAT_RATE, PRIVATE_CHAT_BURST)
+            else:
+                bucket = TokenBucket(GROUP_CHAT_RATE, GROUP_CHAT_BURST)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _drop_idle_buckets(self):
+        cutoff = time.monotonic() - IDLE_BUCKET_SECONDS
+        idle = [chat_id for chat_id, bucket in self._chat_buckets.items()
+                if not bucket.lock.locked() and bucket.idle_since() < cutoff]
+        for chat_id in idle:
+            del self._chat_buckets[chat_id]
+
+    async def _acquire_global(self, priority: int):
+        """
+        Ставит запрос в очередь с приоритетом и ждет, пока он окажется первым
+        и в общей корзине появится токен.
+        """
+        entry = (priority, next(self._sequence))
+        async with self._condition:
+            heapq.heappush(self._waiting, entry)
+            metrics.observe('rate_limiter.queue_depth', len(self._waiting))
+            self._condition.notify_all()
+            try:
+                while True:
+                    if self._waiting[0] == entry:
+                        delay = max(self._global.delay(), self._paused_until - time.monotonic())
+                        if delay <= 0:
+                            break
+                        try:
+                            await asyncio.wait_for(self._condition.wait(), delay)
+                        except asyncio.TimeoutError:
+                            pass
+                    else:
+                        await self._condition.wait()
+            except BaseException:
+                self._waiting.remove(entry)
+                heapq.heapify(self._waiting)
+                self._condition.notify_all()
+                raise
+            heapq.heappop(self._waiting)
+            self._global.consume()
+            self._condition.notify_all()
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get('chat_id')
+        if rate_limit_args is not None:
+            priority = rate_limit_args
+        else:
+            priority = PRIORITY_USER if chat_id is None or self._is_private_chat(chat_id) else PRIORITY_BULK
+
+        chat_limited = chat_id is not None and endpoint.startswith(CHAT_LIMITED_METHODS)
+        for attempt in range(self._max_retries + 1):
+            started = time.monotonic()
+            if chat_limited:
+                await self._chat_bucket(chat_id).acquire()
+            await self._acquire_global(priority)
+            metrics.observe('rate_limiter.wait', time.monotonic() - started)
+
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == self._max_retries:
+                    raise
+                retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') \
+                    else float(e.retry_after)
+                metrics.increment('rate_limiter.retry_after')
+                logger.warning("%s: Telegram просит подождать %.1f с, повтор %s из %s",
+                               endpoint, retry_after, attempt + 1, self._max_retries)
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+                await asyncio.sleep(retry_after)
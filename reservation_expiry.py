@@ -0,0 +1,44 @@
+import heapq
+from datetime import datetime
+
+# Как часто (в секундах) проверяются истекшие брони
+SWEEP_INTERVAL = 15
+# Сколько (в секундах) держится бронь после отправки подтверждения оплаты, если менеджер так и не подтвердил заказ
+PAID_HOLD_DURATION = 3 * 24 * 3600
+
+
+class ExpiryQueue:
+    """
+    Min-куча сроков броней для одного периодического обработчика вместо отдельной задачи на каждую корзину.
+    Проверка «есть ли истекшие брони» стоит O(1); отмененные сроки удаляются из кучи лениво.
+    """
+
+    def __init__(self):
+        self._heap = []
+        # ID пользователя -> его действующие сроки; запись в куче без срока здесь считается отмененной
+        self._deadlines = {}
+
+    def schedule(self, user_id: int, deadline: datetime):
+        """Добавляет срок брони пользователя."""
+        self._deadlines.setdefault(user_id, set()).add(deadline)
+        heapq.heappush(self._heap, (deadline, user_id))
+
+    def cancel(self, user_id: int):
+        """Отменяет все сроки броней пользователя (например, после отправки подтверждения оплаты)."""
+        self._deadlines.pop(user_id, None)
+
+    def pop_due(self, now: datetime) -> set[int]:
+        """Извлекает из кучи все наступившие сроки и возвращает ID пользователей, чьи брони истекли."""
+        due_users = set()
+        while self._heap and self._heap[0][0] <= now:
+            deadline, user_id = heapq.heappop(self._heap)
+            deadlines = self._deadlines.get(user_id)
+            if deadlines and deadline in deadlines:
+                deadlines.discard(deadline)
+                if not deadlines:
+                    del self._deadlines[user_id]
+                due_users.add(user_id)
+        return due_users
+
+    def __len__(self):
+        return sum(len(deadlines) for deadlines in self._deadlines.values())
@@ -0,0 +1,76 @@
+from datetime import datetime, timezone
+
+import inventory
+from async_database import (add_reservations, extend_reservation_deadlines, get_all_reservations,
+                            release_expired_reservations, release_reservations)
+
+# Брони хранятся в таблице reservations; счетчики броней в inventory — их зеркало в памяти.
+# Счетчики меняются только после успешной записи в БД и после перезапуска восстанавливаются через load().
+
+
+def reserved_sizes(product_id: int) -> list[str]:
+    """Возвращает забронированные размеры товара (размер повторяется по числу броней)."""
+    return inventory.held_sizes(product_id)
+
+
+async def reserve(user_id: int, items: list[dict], expires_at: datetime | None) -> bool:
+    """
+    Бронирует для пользователя пары из items ({'product_id', 'size'}) до expires_at.
+    Возвращает False, если свободных пар уже не хватает (их забронировала другая корзина) —
+    тогда не бронируется ни одна пара.
+    """
+    if await add_reservations(user_id, items, expires_at) is None:
+        return False
+    for item in items:
+        inventory.hold(item['product_id'], item['size'])
+    return True
+
+
+async def release(user_id: int, items: list[dict]) -> list[dict]:
+    """
+    Снимает брони пользователя по items. Возвращает элементы, бронь которых действительно была снята:
+    повторная отмена (например, таймер после подтверждения заказа) ничего не меняет.
+    """
+    released = await release_reservations(user_id, items)
+    for item in released:
+        inventory.release(item['product_id'], item['size'])
+    return released
+
+
+async def expire(now: datetime) -> list[dict]:
+    """
+    Снимает все брони со сроком не позже now одной транзакцией.
+    Возвращает снятые брони ({'user_id', 'product_id', 'size'}).
+    """
+    expired = await release_expired_reservations(now)
+    for item in expired:
+        inventory.release(item['product_id'], item['size'])
+    return expired
+
+
+async def extend(user_id: int, expires_at: datetime):
+    """
+    Переносит срок броней пользователя на expires_at: оплата отправлена, бронь держится до подтверждения,
+    но не дольше этого срока, чтобы брошенный или потерянный после перезапуска заказ не держал товар вечно.
+    """
+    await extend_reservation_deadlines(user_id, expires_at)
+
+
+async def load() -> list[dict]:
+    """
+    Перечитывает брони из БД в счетчики inventory и возвращает их списком словарей
+    {'user_id', 'product_id', 'size', 'expires_at'}; expires_at — datetime в UTC или None.
+    """
+    rows = await get_all_reservations()
+    inventory.clear_holds()
+    reservations = []
+    for row in rows:
+        inventory.hold(row['product_id'], row['size'])
+        expires_at = None
+        if row['expires_at']:
+            expires_at = datetime.strptime(row['expires_at'], '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
+        reservations.append({
+            'user_id': row['user_id'], 'product_id': row['product_id'],
+            'size': row['size'], 'expires_at': expires_at,
+        })
+    return reservations
@@ -0,0 +1,66 @@
+import threading
+
+import metrics
+
+_pages = {}  # размер -> {(after_id, before_id): страница результатов поиска}
+_generations = {}  # размер -> номер поколения, растет при каждой инвалидации
+_epoch = 0  # растет при полной очистке кэша
+_lock = threading.Lock()
+
+
+def get(size, cursor: tuple):
+    """
+    Возвращает пару (страница поиска или None, поколение размера).
+    Поколение нужно передать в put, чтобы не сохранить устаревшую страницу,
+    если остатки или брони размера изменились, пока шел запрос к БД.
+    """
+    size = str(size)
+    with _lock:
+        page = _pages.get(size, {}).get(cursor)
+        metrics.increment('search_cache.hits' if page is not None else 'search_cache.misses')
+        return page, (_epoch, _generations.get(size, 0))
+
+
+def put(size, cursor: tuple, page, generation: tuple):
+    """
+    Сохраняет страницу поиска, если с момента промаха размер не инвалидировался.
+    """
+    size = str(size)
+    with _lock:
+        if generation != (_epoch, _generations.get(size, 0)):
+            return
+        _pages.setdefault(size, {})[cursor] = page
+
+
+def invalidate_sizes(sizes):
+    """
+    Удаляет все закэшированные страницы поиска по указанным размерам.
+    """
+    with _lock:
+        for size in {str(size) for size in sizes}:
+            _generations[size] = _generations.get(size, 0) + 1
+            _pages.pop(size, None)
+
+
+def clear():
+    """
+    Полностью очищает кэш.
+    """
+    global _epoch
+    with _lock:
+        _epoch += 1
+        _pages.clear()
+
+
+def stats() -> dict:
+    """
+    Возвращает число попаданий, промахов и количество закэшированных страниц.
+    """
+    counters = metrics.snapshot()
+    with _lock:
+        size = sum(len(pages) for pages in _pages.values())
+    return {
+        'hits': counters.get('search_cache.hits', 0),
+        'misses': counters.get('search_cache.misses', 0),
+        'size': size,
+    }
@@ -0,0 +1,36 @@
+import asyncio
+
+import metrics
+
+# Запросы, выполняющиеся прямо сейчас: ключ -> future с результатом
+_in_flight = {}
+
+
+async def run(key, coroutine_factory):
+    """
+    Выполняет coroutine_factory() один раз для всех одновременных вызовов с одинаковым ключом.
+    Вызовы, пришедшие во время выполнения, ждут тот же результат вместо нового запроса.
+    """
+    future = _in_flight.get(key)
+    if future is not None:
+        metrics.increment('singleflight.coalesced')
+        return await asyncio.shield(future)
+
+    future = asyncio.ensure_future(coroutine_factory())
+    _in_flight[key] = future
+
+    def _release(done_future):
+        if _in_flight.get(key) is done_future:
+            del _in_flight[key]
+
+    future.add_done_callback(_release)
+    # shield: отмена одного из ожидающих не должна отменять общий запрос
+    return await asyncio.shield(future)
+
+
+def forget_all():
+    """
+    Отвязывает все текущие запросы: вызовы после записи в БД начнут новый запрос,
+    а не присоединятся к начатому до изменения данных.
+    """
+    _in_flight.clear()
@@ -0,0 +1,363 @@
+import inspect
+import random
+import sqlite3
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import database
+import db_connection
+import inventory
+import migrations
+from faq_matcher import FaqMatcher
+import product_cache
+import search_cache
+
+# Запросы, которым полный просмотр таблицы нужен по смыслу (текст запроса с пробелами, сжатыми до одного)
+ALLOWED_FULL_SCANS = {
+    # Автомат FAQ строится по всей таблице
+    'SELECT keywords, answer FROM faq ORDER BY id',
+    # Список FAQ для администратора
+    'SELECT id, keywords, answer FROM faq',
+    # Брони загружаются целиком при запуске бота
+    'SELECT id, user_id, product_id, size, expires_at FROM reservations ORDER BY id',
+}
+
+
+def _exercise_every_query():
+    """
+    Вызывает каждую публичную функцию database.py с правдоподобными аргументами.
+    Возвращает множество имен вызванных функций.
+    """
+    product_id = database.add_product('file', 1000, [38, 38, 40], '{"38": 24.5}')
+    calls = {
+        'get_products_page': (0,),
+        'search_products_by_size': (38,),
+        'get_product_by_id': (product_id,),
+        'get_products_by_ids': ([product_id, product_id + 1],),
+        'update_message_id': (product_id, 10),
+        'update_product_sizes': (product_id, '38,40'),
+        'decrement_stock_items': ([{'product_id': product_id, 'size': '38'}],),
+        'increment_stock': (product_id, '38'),
+        'update_product_price': (product_id, 1200),
+        'set_product_sold': (product_id,),
+        'save_post_render_hash': (10, product_id, 'abc'),
+        'get_post_render_hash': (10,),
+        'add_reservations': (7, [{'product_id': product_id, 'size': '38'}], datetime.now(timezone.utc)),
+        'release_expired_reservations': (datetime.now(timezone.utc),),
+        'extend_reservation_deadlines': (7, datetime.now(timezone.utc)),
+        'get_all_reservations': (),
+        'release_reservations': (7, [{'product_id': product_id, 'size': '38'}]),
+        'add_faq': ('доставка, пошта', 'Відправляємо щодня'),
+        'delete_faq_by_id': (1,),
+        'find_faq_by_keywords': ('Коли доставка?',),
+        'get_all_faq': (),
+        'set_chat_status': (7, 'in_progress', 1),
+        'claim_waiting_chat': (7, 2),
+        'get_chat_by_user_id': (7,),
+        'get_chat_by_admin_id': (1,),
+        'delete_chat': (7,),
+        'add_or_update_customer': (7, 'Іван', '+380000000000'),
+        'create_order': (7, 'Київ', 'Новый'),
+        'add_item_to_order': (1, product_id, '38', 1000),
+        'place_order': (
+            {'user_id': 7, 'full_name': 'Іван', 'phone_number': '+380000000000'}, 'Київ',
+            [{'product_id': product_id, 'size': '38', 'price_at_purchase': 1000}],
+        ),
+        'add_message_to_history': (7, 'Привіт', 'user'),
+        'flush_message_history': (),
+        'get_history_for_user': (7,),
+        'get_last_order_summary': (7,),
+        'delete_product_by_id': (product_id,),
+    }
+    for name, args in calls.items():
+        getattr(database, name)(*args)
+    return set(calls) | {'add_product'}
+
+
+@pytest.fixture
+def db(tmp_path):
+    """
+    Подключает чистую базу во временном файле.
+    """
+    db_connection.configure(str(tmp_path / 'test.db'))
+    product_cache.clear()
+    search_cache.clear()
+    inventory.clear_holds()
+    database.init_db()
+    yield
+    db_connection.close_all()
+
+
+@pytest.fixture
+def traced_statements(db, monkeypatch):
+    """
+    Собирает все SQL-запросы, выполненные после init_db.
+    """
+    statements = []
+    original_connect = db_connection._connect
+
+    def connect_with_trace():
+        conn = original_connect()
+        conn.set_trace_callback(statements.append)
+        return conn
+
+    db_connection.close_all()
+    monkeypatch.setattr(db_connection, '_connect', connect_with_trace)
+    yield statements
+
+
+def test_every_public_function_is_exercised(traced_statements):
+    public_functions = {
+        name for name, obj in inspect.getmembers(database, inspect.isfunction)
+        if obj.__module__ == database.__name__ and not name.startswith('_') and name != 'init_db'
+    }
+    assert _exercise_every_query() == public_functions
+
+
+def test_no_query_falls_back_to_full_scan(traced_statements):
+    _exercise_every_query()
+    db_path = db_connection.DB_PATH
+    plan_conn = sqlite3.connect(db_path)
+    try:
+        full_scans = []
+        for statement in traced_statements:
+            if not statement.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE', 'INSERT', 'WITH')):
+                continue
+            for row in plan_conn.execute(f"EXPLAIN QUERY PLAN {statement}"):
+                detail = row[-1]
+                if not detail.startswith('SCAN ') or 'USING' in detail:
+                    continue
+                normalized = ' '.join(statement.split())
+                if normalized not in ALLOWED_FULL_SCANS:
+                    full_scans.append((normalized, detail))
+    finally:
+        plan_conn.close()
+    assert not full_scans, full_scans
+
+
+def test_reservations_never_exceed_stock(db):
+    product_id = database.add_product('file', 1000, [40, 41], '{}')
+    other_id = database.add_product('file', 1000, [40], '{}')
+
+    assert database.add_reservations(1, [{'product_id': product_id, 'size': '40'}], None)
+    assert database.add_reservations(2, [{'product_id': product_id, 'size': '40'}], None) is None
+
+    # Корзина, в которой не хватает одного размера, не бронирует и остальные
+    cart = [{'product_id': product_id, 'size': '41'}, {'product_id': other_id, 'size': '40'},
+            {'product_id': other_id, 'size': '40'}]
+    assert database.add_reservations(2, cart, None) is None
+    assert [(row['user_id'], row['product_id']) for row in database.get_all_reservations()] == [(1, product_id)]
+
+
+def test_stock_decrements_stop_at_zero_and_keep_product_row_in_sync(db):
+    product_id = database.add_product('file', 1000, [38, 40], '{}')
+
+    assert database.decrement_stock_items([{'product_id': product_id, 'size': '38'}]) == [True]
+    assert database.get_product_by_id(product_id)['sizes'] == '40'
+    # Вторая пара размера 40 в той же корзине уже не находится, первая при этом списывается
+    assert database.decrement_stock_items([{'product_id': product_id, 'size': 40},
+                                           {'product_id': product_id, 'size': '40'}]) == [True, False]
+    assert database.decrement_stock_items([{'product_id': product_id, 'size': '40'}]) == [False]
+    product = database.get_product_by_id(product_id)
+    assert (product['sizes'], product['is_sold']) == ('', 1)
+
+    assert database.increment_stock(product_id, '40')
+    product = database.get_product_by_id(product_id)
+    assert (product['sizes'], product['is_sold']) == ('40', 0)
+    assert not database.increment_stock(product_id + 1, '40')
+
+
+def test_faq_prefers_lowest_id_when_keywords_overlap(db):
+    database.add_faq('доставка', 'first')
+    database.add_faq('доставка новою поштою, пошта', 'second')
+    database.add_faq('оплата', 'third')
+
+    assert database.find_faq_by_keywords('Яка ДОСТАВКА новою поштою?') == 'first'
+    assert database.find_faq_by_keywords('Пошта чи оплата?') == 'second'
+    assert database.find_faq_by_keywords('Привіт') is None
+
+    database.delete_faq_by_id(1)
+    assert database.find_faq_by_keywords('Яка доставка новою поштою?') == 'second'
+
+
+def test_faq_matcher_agrees_with_linear_lookup():
+    def linear_lookup(entries, message):
+        message = message.lower()
+        for keywords, answer in entries:
+            if any(keyword in message for keyword in (kw.strip().lower() for kw in keywords.split(',')) if keyword):
+                return answer
+        return None
+
+    rng = random.Random(0)
+    alphabet = 'abа '
+    for _ in range(300):
+        entries = [
+            (','.join(''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 4)))
+                      for _ in range(rng.randint(1, 3))), f'answer {index}')
+            for index in range(rng.randint(0, 5))
+        ]
+        matcher = FaqMatcher(entries)
+        for _ in range(20):
+            message = ''.join(rng.choice(alphabet + 'AБ') for _ in range(rng.randint(0, 12)))
+            assert matcher.find_answer(message) == linear_lookup(entries, message), (entries, message)
+
+
+def test_size_search_pages_by_key_in_both_directions_and_skips_held_pairs(db):
+    product_ids = [database.add_product('file', 1000, [40], '{}') for _ in range(7)]
+    database.add_product('file', 1000, [41], '{}')
+    # Единственная пара второго товара забронирована, поэтому в поиске его нет
+    database.add_reservations(1, [{'product_id': product_ids[1], 'size': '40'}], None)
+    available = [product_ids[0]] + product_ids[2:]
+
+    first, has_prev, has_next = database.search_products_by_size('40', limit=3)
+    assert ([row['id'] for row in first], has_prev, has_next) == (available[:3], False, True)
+
+    second, has_prev, has_next = database.search_products_by_size(40, after_id=first[-1]['id'], limit=3)
+    assert ([row['id'] for row in second], has_prev, has_next) == (available[3:6], True, False)
+
+    back, has_prev, has_next = database.search_products_by_size('40', before_id=second[0]['id'], limit=3)
+    assert ([row['id'] for row in back], has_prev, has_next) == (available[:3], False, True)
+
+    back, has_prev, has_next = database.search_products_by_size('40', before_id=available[-1], limit=3)
+    assert ([row['id'] for row in back], has_prev, has_next) == (available[2:5], True, True)
+
+
+def test_history_merges_buffered_rows_ahead_of_stored_rows(db, monkeypatch):
+    database.add_message_to_history(7, 'stored 1', 'user')
+    database.add_message_to_history(7, 'stored 2', 'bot')
+    database.add_message_to_history(8, 'other user', 'user')
+    database.flush_message_history()
+    database.add_message_to_history(7, 'buffered 1', 'user')
+    database.add_message_to_history(7, 'buffered 2', 'bot')
+
+    def texts(limit):
+        return [row['message_text'] for row in database.get_history_for_user(7, limit)]
+
+    assert texts(3) == ['buffered 2', 'buffered 1', 'stored 2']
+    assert texts(10) == ['buffered 2', 'buffered 1', 'stored 2', 'stored 1']
+
+    # Пока партия записывается, ее строки читаются ровно один раз: и до фиксации,
+    # и сразу после нее, пока партия еще числится в памяти
+    seen_during_write = []
+    original_transaction = database.write_transaction
+
+    @contextmanager
+    def observed_transaction():
+        with original_transaction() as cursor:
+            yield cursor
+            seen_during_write.append(texts(10))
+        seen_during_write.append(texts(10))
+
+    monkeypatch.setattr(database, 'write_transaction', observed_transaction)
+    database.flush_message_history()
+    assert seen_during_write == [['buffered 2', 'buffered 1', 'stored 2', 'stored 1']] * 2
+    assert texts(10) == ['buffered 2', 'buffered 1', 'stored 2', 'stored 1']
+
+
+def test_paid_holds_keep_a_deadline_and_expire(db):
+    product_id = database.add_product('file', 1000, [40, 41], '{}')
+    now = datetime.now(timezone.utc)
+    database.add_reservations(7, [{'product_id': product_id, 'size': '40'}], now - timedelta(minutes=1))
+    database.add_reservations(8, [{'product_id': product_id, 'size': '41'}], now + timedelta(minutes=30))
+
+    database.extend_reservation_deadlines(7, now + timedelta(days=3))
+    assert database.release_expired_reservations(now) == []
+
+    expired = database.release_expired_reservations(now + timedelta(days=3))
+    assert sorted(item['user_id'] for item in expired) == [7, 8]
+    assert database.get_all_reservations() == []
+
+
+def test_only_one_admin_claims_a_waiting_chat(db):
+    database.set_chat_status(7, 'waiting')
+
+    assert database.claim_waiting_chat(7, 1)
+    assert not database.claim_waiting_chat(7, 2)
+    assert not database.claim_waiting_chat(8, 2)
+    chat = database.get_chat_by_user_id(7)
+    assert (chat['status'], chat['admin_id']) == ('in_progress', 1)
+
+
+def test_failed_cart_write_off_leaves_stock_untouched(db, monkeypatch):
+    first_id = database.add_product('file', 1000, [38], '{}')
+    second_id = database.add_product('file', 1000, [40], '{}')
+
+    def failing_sync(cursor, product_id):
+        raise sqlite3.OperationalError('disk I/O error')
+
+    monkeypatch.setattr(database, '_sync_product_row', failing_sync)
+    with pytest.raises(sqlite3.OperationalError):
+        database.decrement_stock_items([{'product_id': first_id, 'size': '38'}, {'product_id': second_id, 'size': '40'}])
+    monkeypatch.undo()
+
+    product_cache.clear()
+    assert [database.get_product_by_id(product_id)['sizes'] for product_id in (first_id, second_id)] == ['38', '40']
+
+
+def test_migration_backfills_sizes_of_a_baseline_database_in_batches(tmp_path, monkeypatch):
+    # База в формате исходной версии бота: размеры только строкой в products, user_version = 0
+    db_path = str(tmp_path / 'baseline.db')
+    conn = sqlite3.connect(db_path)
+    conn.execute("""
+        CREATE TABLE products (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            file_id TEXT NOT NULL,
+            price INTEGER NOT NULL,
+            sizes TEXT NOT NULL,
+            is_sold INTEGER DEFAULT 0,
+            message_id INTEGER
+        )
+    """)
+    conn.executemany("INSERT INTO products (file_id, price, sizes, is_sold) VALUES (?, ?, ?, ?)", [
+        ('a', 1000, '38,38,40', 0), ('b', 1000, '41', 0), ('c', 1000, '', 1), ('d', 1000, ' 42 , 42', 0),
+        ('e', 1000, '39', 0),
+    ])
+    conn.commit()
+    conn.close()
+
+    statements = []
+    original_connect = db_connection._connect
+
+    def connect_with_trace():
+        conn = original_connect()
+        conn.set_trace_callback(statements.append)
+        return conn
+
+    db_connection.configure(db_path)
+    monkeypatch.setattr(db_connection, '_connect', connect_with_trace)
+    try:
+        migrations.migrate(batch_size=2)
+        batches = [statement for statement in statements if 'SELECT id, sizes FROM products' in statement]
+        # 5 товаров пачками по 2: три пачки и пустая выборка в конце
+        assert len(batches) == 4
+        assert migrations.get_schema_version() == migrations.LATEST_VERSION
+
+        with db_connection.read_connection() as conn:
+            rows = conn.execute("SELECT product_id, size, quantity FROM product_sizes ORDER BY product_id, size").fetchall()
+            columns = {row['name'] for row in conn.execute("PRAGMA table_info(products)")}
+        assert [tuple(row) for row in rows] == [(1, '38', 2), (1, '40', 1), (2, '41', 1), (4, '42', 2), (5, '39', 1)]
+        assert 'insole_lengths_json' in columns
+
+        # Повторный запуск при актуальной версии ничего не делает
+        statements.clear()
+        migrations.migrate(batch_size=2)
+        assert statements == ['PRAGMA user_version']
+    finally:
+        db_connection.close_all()
+
+
+def test_deleting_a_product_drops_its_reservations(db):
+    product_id = database.add_product('file', 1000, [40, 41], '{}')
+    other_id = database.add_product('file', 1000, [40], '{}')
+    for reserved_id in (product_id, other_id):
+        database.add_reservations(7, [{'product_id': reserved_id, 'size': '40'}], None)
+        inventory.hold(reserved_id, '40')
+
+    database.delete_product_by_id(product_id)
+
+    assert [row['product_id'] for row in database.get_all_reservations()] == [other_id]
+    assert inventory.held_sizes(product_id) == []
+    assert inventory.free_sizes(product_id) == []
+    assert inventory.held_sizes(other_id) == ['40']
@@ -0,0 +1,99 @@
+from contextlib import contextmanager
+
+import pytest
+
+import database
+import db_connection
+import product_cache
+import search_cache
+
+
+@pytest.fixture(autouse=True)
+def empty_cache():
+    product_cache.clear()
+    yield
+    product_cache.clear()
+
+
+def _store(product_id: int, product):
+    _, generation = product_cache.get(product_id)
+    product_cache.put(product_id, product, generation)
+
+
+def test_least_recently_used_product_is_evicted(monkeypatch):
+    monkeypatch.setattr(product_cache, 'PRODUCT_CACHE_SIZE', 2)
+    _store(1, 'first')
+    _store(2, 'second')
+    # Обращение к первому товару делает вторым кандидатом на вытеснение второй товар
+    assert product_cache.get(1)[0] == 'first'
+    _store(3, 'third')
+
+    assert product_cache.get(2)[0] is None
+    assert product_cache.get(1)[0] == 'first'
+    assert product_cache.get(3)[0] == 'third'
+
+
+def test_entries_expire_after_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(product_cache.time, 'monotonic', lambda: now[0])
+    _store(1, 'product')
+
+    now[0] += product_cache.PRODUCT_CACHE_TTL - 1
+    assert product_cache.get(1)[0] == 'product'
+    now[0] += 1
+    assert product_cache.get(1)[0] is None
+    assert product_cache.stats()['size'] == 0
+
+
+def test_load_that_raced_an_invalidation_is_not_cached():
+    # Чтение промахнулось и пошло в БД, а за это время товар изменили
+    _, generation = product_cache.get(1)
+    product_cache.invalidate(1)
+    product_cache.put(1, 'stale row', generation)
+    assert product_cache.get(1)[0] is None
+
+    # Следующая загрузка уже с новым поколением сохраняется
+    _store(1, 'fresh row')
+    assert product_cache.get(1)[0] == 'fresh row'
+
+
+def test_load_that_raced_a_clear_is_not_cached():
+    _, generation = product_cache.get(1)
+    product_cache.clear()
+    product_cache.put(1, 'stale row', generation)
+    assert product_cache.get(1)[0] is None
+
+
+def test_invalidate_drops_only_the_changed_product():
+    _store(1, 'first')
+    _store(2, 'second')
+    product_cache.invalidate(1)
+    assert product_cache.get(1)[0] is None
+    assert product_cache.get(2)[0] == 'second'
+
+
+def test_product_row_read_before_a_concurrent_write_is_not_cached(tmp_path, monkeypatch):
+    db_connection.configure(str(tmp_path / 'test.db'))
+    search_cache.clear()
+    database.init_db()
+    try:
+        product_id = database.add_product('file', 1000, [40], '{}')
+        original_read = database.read_connection
+        writes = []
+
+        @contextmanager
+        def read_then_write():
+            # Цена меняется после того, как чтение уже получило строку, но до ее сохранения в кэш
+            with original_read() as conn:
+                yield conn
+            if not writes:
+                writes.append(product_id)
+                database.update_product_price(product_id, 1500)
+
+        monkeypatch.setattr(database, 'read_connection', read_then_write)
+        assert database.get_product_by_id(product_id)['price'] == 1000
+        monkeypatch.undo()
+
+        assert database.get_product_by_id(product_id)['price'] == 1500
+    finally:
+        db_connection.close_all()
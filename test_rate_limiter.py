@@ -0,0 +1,134 @@
+import asyncio
+import time
+from datetime import timedelta
+
+import pytest
+from telegram.error import RetryAfter
+
+import rate_limiter
+from rate_limiter import PRIORITY_BULK, PRIORITY_USER, OutboundRateLimiter, TokenBucket
+
+
+async def _limiter(**kwargs) -> OutboundRateLimiter:
+    limiter = OutboundRateLimiter(**kwargs)
+    await limiter.initialize()
+    return limiter
+
+
+def test_token_bucket_spends_the_burst_and_then_paces_requests():
+    async def scenario():
+        bucket = TokenBucket(rate=20, burst=2)
+        started = time.monotonic()
+        moments = []
+        for _ in range(4):
+            await bucket.acquire()
+            moments.append(time.monotonic() - started)
+        return moments
+
+    moments = asyncio.run(scenario())
+    assert moments[1] < 0.02
+    # После запаса в 2 токена каждый следующий ждет ~1/20 с
+    assert moments[2] >= 0.04
+    assert moments[3] - moments[2] >= 0.04
+
+
+def test_user_requests_pass_the_global_limit_before_bulk_ones():
+    async def scenario():
+        limiter = await _limiter()
+        limiter._global = TokenBucket(rate=50, burst=1)
+        limiter._global.consume()
+        order = []
+
+        async def send(tag):
+            order.append(tag)
+
+        # Массовая отправка встает в очередь первой, но пропускает вперед ответ пользователю
+        bulk = asyncio.create_task(limiter.process_request(
+            send, ('bulk',), {}, 'getChat', {}, PRIORITY_BULK))
+        await asyncio.sleep(0)
+        user = asyncio.create_task(limiter.process_request(
+            send, ('user',), {}, 'getChat', {}, PRIORITY_USER))
+        await asyncio.gather(bulk, user)
+        return order
+
+    assert asyncio.run(scenario()) == ['user', 'bulk']
+
+
+def test_default_priority_prefers_private_chats_over_channels():
+    async def scenario():
+        limiter = await _limiter()
+        limiter._global = TokenBucket(rate=50, burst=1)
+        limiter._global.consume()
+        order = []
+
+        async def send(tag):
+            order.append(tag)
+
+        channel = asyncio.create_task(limiter.process_request(
+            send, ('channel',), {}, 'sendMessage', {'chat_id': -100}, None))
+        await asyncio.sleep(0)
+        private = asyncio.create_task(limiter.process_request(
+            send, ('private',), {}, 'sendMessage', {'chat_id': 42}, None))
+        await asyncio.gather(channel, private)
+        return order
+
+    assert asyncio.run(scenario()) == ['private', 'channel']
+
+
+def test_retry_after_pauses_and_retries_the_request():
+    async def scenario():
+        limiter = await _limiter()
+        calls = []
+
+        async def flaky():
+            calls.append(time.monotonic())
+            if len(calls) < 3:
+                raise RetryAfter(timedelta(milliseconds=30))
+            return 'ok'
+
+        result = await limiter.process_request(flaky, (), {}, 'sendMessage', {'chat_id': 42}, None)
+        return result, calls, limiter
+
+    result, calls, limiter = asyncio.run(scenario())
+    assert result == 'ok'
+    assert len(calls) == 3
+    assert calls[1] - calls[0] >= 0.025
+    assert limiter._paused_until > 0
+
+
+def test_retry_after_is_raised_once_retries_are_exhausted():
+    async def scenario():
+        limiter = await _limiter(max_retries=2)
+        calls = 0
+
+        async def always_busy():
+            nonlocal calls
+            calls += 1
+            raise RetryAfter(timedelta(milliseconds=1))
+
+        with pytest.raises(RetryAfter):
+            await limiter.process_request(always_busy, (), {}, 'sendMessage', {'chat_id': 42}, None)
+        return calls
+
+    assert asyncio.run(scenario()) == 3
+
+
+def test_only_send_and_edit_methods_use_chat_buckets():
+    async def scenario():
+        limiter = await _limiter()
+
+        async def call():
+            return None
+
+        await limiter.process_request(call, (), {}, 'getChat', {'chat_id': 42}, None)
+        await limiter.process_request(call, (), {}, 'answerCallbackQuery', {'chat_id': 43}, None)
+        assert limiter._chat_buckets == {}
+
+        await limiter.process_request(call, (), {}, 'sendMessage', {'chat_id': 42}, None)
+        await limiter.process_request(call, (), {}, 'editMessageText', {'chat_id': -100}, None)
+        return limiter
+
+    limiter = asyncio.run(scenario())
+    assert set(limiter._chat_buckets) == {42, -100}
+    assert limiter._chat_buckets[42].rate == rate_limiter.PRIVATE_CHAT_RATE
+    assert limiter._chat_buckets[-100].rate == rate_limiter.GROUP_CHAT_RATE
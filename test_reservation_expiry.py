@@ -0,0 +1,59 @@
+from datetime import datetime, timedelta, timezone
+
+from reservation_expiry import ExpiryQueue
+
+NOW = datetime(2026, 1, 1, 12, 0, tzinfo=timezone.utc)
+
+
+def _at(minutes: int) -> datetime:
+    return NOW + timedelta(minutes=minutes)
+
+
+def test_due_deadlines_are_popped_in_order_up_to_now_inclusive():
+    queue = ExpiryQueue()
+    queue.schedule(3, _at(30))
+    queue.schedule(1, _at(10))
+    queue.schedule(2, _at(20))
+
+    assert queue.pop_due(_at(5)) == set()
+    # Срок, равный текущему моменту, уже истек
+    assert queue.pop_due(_at(20)) == {1, 2}
+    assert len(queue) == 1
+    assert queue.pop_due(_at(29)) == set()
+    assert queue.pop_due(_at(31)) == {3}
+    assert len(queue) == 0
+
+
+def test_cancelled_deadlines_are_skipped_lazily():
+    queue = ExpiryQueue()
+    queue.schedule(1, _at(10))
+    queue.schedule(2, _at(10))
+    queue.cancel(1)
+
+    assert len(queue) == 1
+    assert queue.pop_due(_at(10)) == {2}
+    # Отмененная запись тоже извлечена из кучи, а не осталась в ней
+    assert queue._heap == []
+
+
+def test_rescheduled_user_expires_only_at_the_new_deadline():
+    queue = ExpiryQueue()
+    queue.schedule(1, _at(30))
+    # Оплата отправлена: прежний срок отменяется, бронь продлевается
+    queue.cancel(1)
+    queue.schedule(1, _at(3 * 24 * 60))
+
+    assert queue.pop_due(_at(30)) == set()
+    assert len(queue) == 1
+    assert queue.pop_due(_at(3 * 24 * 60)) == {1}
+
+
+def test_user_with_several_deadlines_is_due_at_each_of_them():
+    queue = ExpiryQueue()
+    queue.schedule(1, _at(10))
+    queue.schedule(1, _at(20))
+
+    assert queue.pop_due(_at(10)) == {1}
+    assert len(queue) == 1
+    assert queue.pop_due(_at(20)) == {1}
+    assert len(queue) == 0
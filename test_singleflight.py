@@ -0,0 +1,104 @@
+import asyncio
+import threading
+
+import async_database
+import singleflight
+
+
+def test_concurrent_calls_with_one_key_share_a_single_call():
+    async def scenario():
+        calls = []
+
+        async def load(key):
+            calls.append(key)
+            await asyncio.sleep(0.01)
+            return f'result {key}'
+
+        results = await asyncio.gather(
+            singleflight.run('a', lambda: load('a')),
+            singleflight.run('a', lambda: load('a')),
+            singleflight.run('b', lambda: load('b')),
+        )
+        return results, calls
+
+    results, calls = asyncio.run(scenario())
+    assert results == ['result a', 'result a', 'result b']
+    assert calls == ['a', 'b']
+    assert singleflight._in_flight == {}
+
+
+def test_cancelling_the_first_caller_does_not_cancel_the_others():
+    async def scenario():
+        calls = 0
+
+        async def load():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0.02)
+            return 'shared'
+
+        first = asyncio.create_task(singleflight.run('key', load))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(singleflight.run('key', load))
+        await asyncio.sleep(0)
+        first.cancel()
+        return first, await second, calls
+
+    first, second_result, calls = asyncio.run(scenario())
+    assert first.cancelled()
+    assert second_result == 'shared'
+    assert calls == 1
+
+
+def test_calls_after_forget_all_start_a_new_request():
+    async def scenario():
+        calls = 0
+
+        async def load():
+            nonlocal calls
+            calls += 1
+            value = calls
+            await asyncio.sleep(0.01)
+            return value
+
+        before = asyncio.create_task(singleflight.run('key', load))
+        await asyncio.sleep(0)
+        # Запись в БД: запрос, начатый до нее, не должен отдать свой результат новым вызовам
+        singleflight.forget_all()
+        after = asyncio.create_task(singleflight.run('key', load))
+        return await before, await after
+
+    assert asyncio.run(scenario()) == (1, 2)
+
+
+def test_coalesced_lookups_run_once_in_the_db_thread_and_writes_reset_them():
+    calls = []
+    release = threading.Event()
+
+    def read(product_id):
+        calls.append(product_id)
+        release.wait(1)
+        return [product_id]
+
+    def write(product_id):
+        return product_id
+
+    coalesced_read = async_database._coalesced(async_database._run_in_db_thread(read))
+    invalidating_write = async_database._invalidates_lookups(async_database._run_in_db_thread(write))
+
+    async def scenario():
+        first = asyncio.create_task(coalesced_read(7))
+        second = asyncio.create_task(coalesced_read(7))
+        await asyncio.sleep(0.01)
+        await invalidating_write(7)
+        third = asyncio.create_task(coalesced_read(7))
+        await asyncio.sleep(0.01)
+        release.set()
+        return await asyncio.gather(first, second, third)
+
+    first, second, third = asyncio.run(scenario())
+    assert first == second == third == [7]
+    # Каждый вызов получает свою копию списка
+    assert first is not second
+    # Чтение после записи не присоединилось к начатому до нее
+    assert calls == [7, 7]
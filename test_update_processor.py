@@ -0,0 +1,83 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+from telegram import Chat, Message, Update, User
+
+from update_processor import KeyedUpdateProcessor
+
+
+def _update(update_id: int, user_id: int) -> Update:
+    chat = Chat(user_id, Chat.PRIVATE)
+    return Update(update_id, message=Message(update_id, datetime.now(), chat, from_user=User(user_id, 'x', False)))
+
+
+def test_updates_of_one_user_run_in_order_while_other_users_proceed():
+    async def scenario():
+        processor = KeyedUpdateProcessor(4)
+        events = []
+
+        async def handle(tag, delay):
+            events.append(('start', tag))
+            await asyncio.sleep(delay)
+            events.append(('end', tag))
+
+        # Первое обновление пользователя 1 самое долгое: следующие его обновления ждут, пользователь 2 — нет
+        await asyncio.gather(
+            processor.process_update(_update(1, 1), handle('1a', 0.05)),
+            processor.process_update(_update(2, 1), handle('1b', 0)),
+            processor.process_update(_update(3, 2), handle('2a', 0)),
+            processor.process_update(_update(4, 1), handle('1c', 0)),
+        )
+        return events, processor
+
+    events, processor = asyncio.run(scenario())
+    own = [event for event in events if event[1].startswith('1')]
+    assert own == [('start', '1a'), ('end', '1a'), ('start', '1b'), ('end', '1b'), ('start', '1c'), ('end', '1c')]
+    assert events.index(('end', '2a')) < events.index(('end', '1a'))
+    assert processor._locks == {}
+
+
+def test_waiting_updates_of_one_user_do_not_take_the_shared_slots():
+    async def scenario():
+        processor = KeyedUpdateProcessor(2)
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        finished = {}
+
+        async def handle(tag, delay):
+            await asyncio.sleep(delay)
+            finished[tag] = loop.time() - started
+
+        await asyncio.gather(
+            *(processor.process_update(_update(index, 1), handle(f'1-{index}', 0.1)) for index in range(4)),
+            processor.process_update(_update(10, 2), handle('2', 0)),
+        )
+        return finished
+
+    finished = asyncio.run(scenario())
+    assert finished['2'] < 0.05
+
+
+def test_cap_limits_concurrency_across_users_and_is_reported():
+    async def scenario():
+        processor = KeyedUpdateProcessor(3)
+        peak = 0
+
+        async def handle():
+            nonlocal peak
+            peak = max(peak, processor.current_concurrent_updates)
+            await asyncio.sleep(0.01)
+
+        await asyncio.gather(*(processor.process_update(_update(index, index), handle()) for index in range(10)))
+        return processor, peak
+
+    processor, peak = asyncio.run(scenario())
+    assert peak == 3
+    assert processor.max_concurrent_updates == 3
+    assert processor.current_concurrent_updates == 0
+
+
+def test_non_positive_cap_is_rejected():
+    with pytest.raises(ValueError):
+        KeyedUpdateProcessor(0)
@@ -0,0 +1,89 @@
+import asyncio
+import time
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+import metrics
+
+MAX_CONCURRENT_UPDATES = 32
+
+# Предел семафора базового класса. PTB берет его до вызова do_process_update, то есть раньше очереди
+# пользователя, поэтому он фактически снят, а настоящий предел задает _slots внутри замка пользователя
+_UNLIMITED = 2 ** 31 - 1
+
+
+class KeyedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Обрабатывает обновления параллельно (не больше max_concurrent_updates одновременно),
+    но обновления одного пользователя — строго по очереди, в порядке поступления.
+    Так диалоги ConversationHandler и корзина пользователя не видят гонок, а разные клиенты
+    не ждут друг друга. Обновления без пользователя (посты в канале) упорядочиваются по чату.
+    Место в общем пределе занимается только после своей очереди, поэтому ожидающие обновления
+    одного пользователя не отнимают места у остальных.
+    """
+
+    def __init__(self, max_concurrent_updates: int = MAX_CONCURRENT_UPDATES):
+        if max_concurrent_updates < 1:
+            raise ValueError("`max_concurrent_updates` must be a positive integer!")
+        # Базовый класс создает свой семафор по max_concurrent_updates, поэтому на время его
+        # инициализации свойство возвращает _UNLIMITED
+        self._limit = _UNLIMITED
+        super().__init__(_UNLIMITED)
+        self._limit = max_concurrent_updates
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        self._running = 0
+        # Ключ -> [замок, число обновлений, которые держат или ждут замок]
+        self._locks = {}
+
+    @property
+    def max_concurrent_updates(self) -> int:
+        return self._limit
+
+    @property
+    def current_concurrent_updates(self) -> int:
+        return self._running
+
+    @staticmethod
+    def _key(update: object):
+        if isinstance(update, Update):
+            if update.effective_user:
+                return 'user', update.effective_user.id
+            if update.effective_chat:
+                return 'chat', update.effective_chat.id
+        return None
+
+    async def _run(self, coroutine, started: float) -> None:
+        """Занимает место в общем пределе и выполняет обработку обновления."""
+        async with self._slots:
+            # Ожидание учитывает и очередь пользователя, и ожидание свободного места
+            metrics.observe('updates.queue_wait', time.monotonic() - started)
+            self._running += 1
+            metrics.observe('updates.concurrent', self._running)
+            try:
+                await coroutine
+            finally:
+                self._running -= 1
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        started = time.monotonic()
+        key = self._key(update)
+        if key is None:
+            await self._run(coroutine, started)
+            return
+
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await self._run(coroutine, started)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass